@@ -0,0 +1,144 @@
+# coding=utf-8
+
+"""
+Measure what a Resource costs on top of the driver.
+
+Each case runs a mongothin call and, when it makes sense, the equivalent direct call on the same in-process fake
+collection, so the difference is mongothin's overhead. No server needed:
+
+    python -m benchmarks.bench_resource --output bench_output.txt
+
+The output is JSON, compare it between releases to catch regressions.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import timeit
+
+from bson import ObjectId
+import pymongo
+
+import mongothin
+from mongothin.metrics import MetricsRegistry
+from mongothin.resource import Resource
+from benchmarks.fake import FakeDatabase
+
+
+_db = FakeDatabase()
+
+
+class BenchResource(Resource):
+    _collection = 'bench'
+
+    @classmethod
+    def _get_db(cls):
+        return _db
+
+
+class ShardedBenchResource(BenchResource):
+    _collection = 'bench'
+    _shard = (mongothin.object_id_shard, 'shard',)
+
+
+class MeasuredBenchResource(BenchResource):
+    _collection = 'bench'
+    _metrics = MetricsRegistry(enabled=True)
+
+
+def measure(function, iterations):
+    """
+    Time each call of function
+    :return: {'ops_per_sec', 'p50_us', 'p99_us'}
+    """
+    timer = timeit.default_timer
+    latencies = []
+    for _ in xrange(0, iterations):
+        start = timer()
+        function()
+        latencies.append(timer() - start)
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'iterations': iterations,
+        'ops_per_sec': iterations / total if total else None,
+        'p50_us': latencies[len(latencies) // 2] * 1e6,
+        'p99_us': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e6,
+    }
+
+
+def cases(sizes):
+    """
+    :return: A list of (name, size, mongothin callable, direct callable or None)
+    """
+    collection = _db['bench']
+    object_id = ObjectId()
+    collection.insert({'_id': object_id, 'test': 'test'})
+
+    yield '_make_specs', 1, lambda: BenchResource._make_specs(str(object_id)), None
+    yield '_add_shard', 1, lambda: ShardedBenchResource._add_shard({'_id': object_id}), None
+    yield 'find_one', 1, lambda: BenchResource.find_one(object_id), lambda: collection.find_one({'_id': object_id})
+    # Compared to the same call without metrics, the overhead is the cost of recording it
+    yield ('find_one_metrics', 1, lambda: MeasuredBenchResource.find_one(object_id),
+           lambda: BenchResource.find_one(object_id))
+    yield ('find_one_sharded', 1, lambda: ShardedBenchResource.find_one(object_id),
+           lambda: collection.find_one({'_id': object_id}))
+
+    for size in sizes:
+        ids = [ObjectId() for _ in xrange(0, size)]
+        collection.insert([{'_id': _id} for _id in ids])
+        str_ids = [str(_id) for _id in ids]
+        missing_ids = str_ids[:-1] + [str(ObjectId())]
+
+        def resolve_missing(missing_ids=missing_ids):
+            try:
+                BenchResource.resolve(missing_ids)
+            except mongothin.resource.MissingIdsException:
+                pass
+
+        direct = lambda ids=ids: list(collection.find({'_id': {'$in': ids}}))
+        yield 'find_in', size, lambda str_ids=str_ids: list(BenchResource.find_in(str_ids)), direct
+        yield 'find_in_sharded', size, lambda str_ids=str_ids: list(ShardedBenchResource.find_in(str_ids)), direct
+        yield 'resolve', size, lambda str_ids=str_ids: BenchResource.resolve(str_ids), direct
+        yield 'resolve_missing', size, resolve_missing, direct
+
+
+def run(sizes, calls):
+    """
+    :param sizes: The id list sizes for the multi-get cases
+    :param calls: Roughly the number of ids processed per case, the iterations are derived from it
+    """
+    results = []
+    for name, size, function, direct in cases(sizes):
+        iterations = max(10, calls // size)
+        result = {'name': name, 'size': size, 'mongothin': measure(function, iterations)}
+        if direct is not None:
+            result['direct'] = measure(direct, iterations)
+            result['overhead_us'] = result['mongothin']['p50_us'] - result['direct']['p50_us']
+        results.append(result)
+    return {
+        'python': platform.python_version(),
+        'pymongo': pymongo.version,
+        'results': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10,100,1000,10000,100000', help='Comma separated id list sizes')
+    parser.add_argument('--calls', type=int, default=100000, help='Ids processed per case')
+    parser.add_argument('--output', help='Write the JSON there instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = run([int(size) for size in args.sizes.split(',')], args.calls)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
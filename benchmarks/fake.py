@@ -0,0 +1,73 @@
+# coding=utf-8
+
+"""
+An in-process stand-in for a pymongo database, so the benchmarks measure mongothin and not the network
+"""
+
+import copy
+
+
+class FakeCursor(object):
+    """
+    Iterates over the matching documents, like a pymongo cursor
+    """
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def __iter__(self):
+        return iter(self.documents)
+
+
+class FakeCollection(object):
+    """
+    Supports what the benchmarks need: lookups by _id, with $in, and the shard key ignored
+    """
+
+    def __init__(self):
+        self.documents = {}
+
+    def insert(self, document, **kwargs):
+        if isinstance(document, list):
+            for doc in document:
+                self.documents[doc['_id']] = doc
+            return [doc['_id'] for doc in document]
+        self.documents[document['_id']] = document
+        return document['_id']
+
+    def _match(self, specs):
+        _id = specs.get('_id')
+        if isinstance(_id, dict):
+            return [self.documents[i] for i in _id['$in'] if i in self.documents]
+        if _id in self.documents:
+            return [self.documents[_id]]
+        return []
+
+    def find_one(self, specs, *args, **kwargs):
+        documents = self._match(specs)
+        return copy.copy(documents[0]) if documents else None
+
+    def find(self, specs, *args, **kwargs):
+        return FakeCursor(self._match(specs))
+
+    def update(self, specs, document, *args, **kwargs):
+        documents = self._match(specs)
+        for doc in documents:
+            doc.update(document.get('$set', {}))
+        return {'n': len(documents)}
+
+    def remove(self, specs, *args, **kwargs):
+        documents = self._match(specs)
+        for doc in documents:
+            del self.documents[doc['_id']]
+        return {'n': len(documents)}
+
+
+class FakeDatabase(dict):
+    """
+    Creates the collections on access, like a pymongo database
+    """
+
+    def __missing__(self, name):
+        collection = self[name] = FakeCollection()
+        return collection
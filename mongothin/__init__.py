@@ -2,8 +2,15 @@
 """
 Some utilities
 """
+import struct
+
 from bson import ObjectId
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def raw_updater(data):
     """
@@ -23,6 +30,15 @@ def default_updater(data):
     return {'$set': data}
 
 
+def inc_updater(data):
+    """
+    Takes a dict of increments and adds $inc
+    :param data:
+    :return:
+    """
+    return {'$inc': data}
+
+
 def base_encode(number, alphabet='ABCDEFGHIJKLMNOPQRSTUVWXYZ'):
     """
     Encode in base 26, making sure it has 2 letters. To be used with object_id_shard
@@ -39,6 +55,17 @@ def base_encode(number, alphabet='ABCDEFGHIJKLMNOPQRSTUVWXYZ'):
     return base_encoded
 
 
+SHARD_COUNT = 26 * 26
+
+# The 12 bytes of an ObjectId as 3 big endian 32 bits integers: a * 2**64 + b * 2**32 + c
+_OBJECT_ID_STRUCT = struct.Struct('>III')
+_MOD_2_64 = 2 ** 64 % SHARD_COUNT
+_MOD_2_32 = 2 ** 32 % SHARD_COUNT
+
+# Use numpy for the batches bigger than this
+NUMPY_THRESHOLD = 1000
+
+
 def object_id_shard(specs):
     """
     create a shard id from an object_id.
@@ -56,10 +83,55 @@ def object_id_shard(specs):
     _id = specs.get('_id')
     if not _id:
         return None
-    if not isinstance(_id, (ObjectId, str, unicode)):
+    if isinstance(_id, ObjectId):
+        a, b, c = _OBJECT_ID_STRUCT.unpack(_id.binary)
+        return SHARD_LABELS[(a * _MOD_2_64 + b * _MOD_2_32 + c) % SHARD_COUNT]
+    if not isinstance(_id, (str, unicode)):
         return None
-    _id = str(_id)
     i = int(_id, 16)  # get the integer value
-    mod = i % (26 * 26)
-    shard = base_encode(mod)  # This gives me a string from AA to ZZ
-    return shard
+    return SHARD_LABELS[i % SHARD_COUNT]
+
+
+def object_id_shard_many(ids):
+    """
+    object_id_shard for a list of ids at once, :method:Resource.find_in uses it to add the shard values of the ids.
+    Uses numpy, when installed, for big lists of ObjectIds.
+    :param ids: A list of ids
+    :return: The list of their shard ids, None for the ids object_id_shard can't shard
+    """
+    if numpy is not None and len(ids) >= NUMPY_THRESHOLD and all(isinstance(_id, ObjectId) for _id in ids):
+        words = numpy.frombuffer(b''.join(_id.binary for _id in ids), dtype='>u4').reshape(-1, 3).astype(numpy.uint64)
+        mods = (words[:, 0] * _MOD_2_64 + words[:, 1] * _MOD_2_32 + words[:, 2]) % SHARD_COUNT
+        return [SHARD_LABELS[mod] for mod in mods.tolist()]
+    return [object_id_shard({'_id': _id}) for _id in ids]
+
+object_id_shard.many = object_id_shard_many
+
+
+SHARD_LABELS = [base_encode(i) for i in xrange(0, SHARD_COUNT)]  # AA to ZZ
+_SHARD_NUMBERS = dict((label, i) for i, label in enumerate(SHARD_LABELS))
+
+
+def object_id_router(aliases):
+    """
+    Create a router spreading documents over connection aliases by their object_id_shard, for a RoutedResource.
+    Each alias gets a range of shard ids so you can move shard ids between clusters when resharding.
+
+    Use like this in a RoutedResource: _aliases = ('users1', 'users2'); _router = object_id_router(_aliases)
+
+    :param aliases: The list of aliases
+    :return: A function taking specs and returning an alias, None if the specs have no usable _id
+    """
+    aliases = list(aliases)
+
+    def alias_for(shard):
+        if shard is None:
+            return None
+        return aliases[_SHARD_NUMBERS[shard] * len(aliases) // SHARD_COUNT]
+
+    def router(specs):
+        return alias_for(object_id_shard(specs))
+
+    router.many = lambda ids: [alias_for(shard) for shard in object_id_shard_many(ids)]
+    return router
+
@@ -0,0 +1,91 @@
+# coding=utf-8
+
+"""
+A Resource whose calls don't block the caller.
+
+Every ``async_`` method runs the blocking call, retries and backoff included, on a bounded thread pool and returns a
+:class:concurrent.futures.Future. From asyncio use ``await asyncio.wrap_future(UserResource.async_find_one(doc_id))``,
+from tornado yield the future directly.
+
+Requires the ``futures`` backport on python 2: ``pip install mongothin[async]``
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from mongothin import raw_updater
+from mongothin.resource import Resource
+
+
+class AsyncResource(Resource):
+    """
+    Same configuration as a Resource, plus:
+
+        >>> class UserResource(AsyncResource):
+        >>>     # Number of threads running the calls of this Resource. This bounds the queries in flight.
+        >>>     _async_workers = 10
+
+    The cursor returning methods (find, find_in, resolve) fetch all the documents in the pool and return a list,
+    use skip/limit to bound them.
+    """
+
+    _async_workers = 10
+
+    @classmethod
+    def _get_executor(cls):
+        return cls._get_lazy('_executor', lambda: ThreadPoolExecutor(cls._async_workers))
+
+    @classmethod
+    def _submit(cls, function, *args, **kwargs):
+        return cls._get_executor().submit(function, *args, **kwargs)
+
+    @classmethod
+    def _fetch(cls, function, *args, **kwargs):
+        return list(function(*args, **kwargs))
+
+    @classmethod
+    def async_insert(cls, document, doc_id=None):
+        """ Future of :method:Resource.insert
+        """
+        return cls._submit(cls.insert, document, doc_id)
+
+    @classmethod
+    def async_update(cls, doc_id, document, specs=None, updater=raw_updater, *args, **kwargs):
+        """ Future of :method:Resource.update
+        """
+        return cls._submit(cls.update, doc_id, document, specs, updater, *args, **kwargs)
+
+    @classmethod
+    def async_update_dict(cls, doc_id, document, specs=None, *args, **kwargs):
+        """ Future of :method:Resource.update_dict
+        """
+        return cls._submit(cls.update_dict, doc_id, document, specs, *args, **kwargs)
+
+    @classmethod
+    def async_remove(cls, doc_id, specs=None):
+        """ Future of :method:Resource.remove
+        """
+        return cls._submit(cls.remove, doc_id, specs)
+
+    @classmethod
+    def async_find_one(cls, doc_id, specs=None, *args, **kwargs):
+        """ Future of :method:Resource.find_one
+        """
+        return cls._submit(cls.find_one, doc_id, specs, *args, **kwargs)
+
+    @classmethod
+    def async_find(cls, specs, skip=0, limit=10, *args, **kwargs):
+        """ Future of the list of documents returned by :method:Resource.find
+        """
+        return cls._submit(cls._fetch, cls.find, specs, skip, limit, *args, **kwargs)
+
+    @classmethod
+    def async_find_in(cls, doc_ids, *args, **kwargs):
+        """ Future of the list of documents returned by :method:Resource.find_in
+        """
+        return cls._submit(cls._fetch, cls.find_in, doc_ids, *args, **kwargs)
+
+    @classmethod
+    def async_resolve(cls, doc_ids, *args, **kwargs):
+        """ Future of :method:Resource.resolve
+        """
+        return cls._submit(cls.resolve, doc_ids, *args, **kwargs)
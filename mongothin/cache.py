@@ -0,0 +1,331 @@
+# coding=utf-8
+
+"""
+Document caches for Resources
+"""
+
+from array import array
+from collections import OrderedDict
+import hashlib
+import math
+import struct
+import sys
+import threading
+import time
+import weakref
+
+
+class Cache(object):
+    """
+    The interface of a Resource cache. Keys are coerced _id values, values are documents.
+    Implement it to plug a shared backend (memcached, redis, ...).
+    """
+
+    def get(self, key):
+        """
+        :return: The cached document or None
+        """
+        raise NotImplementedError()
+
+    def set(self, key, document):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def stats(self):
+        """
+        :return: A dict with at least the hits, misses and evictions counters
+        """
+        raise NotImplementedError()
+
+
+class LRUCache(Cache):
+    """
+    A thread-safe in-process cache bounded in size, with an optional time to live.
+
+    Cached documents are shared between callers, don't mutate them.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        """
+        :param maxsize: The maximum number of documents kept
+        :param ttl: How long a document stays valid, in seconds. None keeps it until evicted
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            document, expires = entry
+            if expires is not None and expires < time.time():
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._data[key] = entry  # Most recently used goes last
+            self.hits += 1
+            return document
+
+    def set(self, key, document):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (document, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._data),
+            }
+
+
+class Generations(object):
+    """
+    Counts the invalidations of the keys of a cache, so a document read before an invalidation isn't cached after it:
+
+        >>> generation = generations.get(key)
+        >>> document = read(key)
+        >>> cache.set(key, document)
+        >>> if generations.get(key) != generation:
+        >>>     cache.delete(key)
+
+    Invalidate with bump(key), then delete the key. The keys share a fixed number of counters, a collision only drops
+    a fill.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self._counters = [0] * size
+        self._all = 0
+
+    def get(self, key):
+        return self._all, self._counters[hash(key) % self.size]
+
+    def bump(self, key):
+        self._counters[hash(key) % self.size] += 1
+
+    def bump_all(self):
+        self._all += 1
+
+
+_generations = weakref.WeakKeyDictionary()
+_generations_lock = threading.Lock()
+
+
+def get_generations(cache):
+    """
+    :param cache: A Cache or a NegativeCache
+    :return: Its Generations, shared by all the Resources using it
+    """
+    generations = _generations.get(cache)
+    if generations is None:
+        with _generations_lock:
+            generations = _generations.setdefault(cache, Generations())
+    return generations
+
+
+class NegativeCache(object):
+    """
+    The interface of a Resource negative cache: the coerced _id values known to match no document, so their lookups
+    don't reach the server.
+    """
+
+    def add(self, key):
+        raise NotImplementedError()
+
+    def discard(self, key):
+        raise NotImplementedError()
+
+    def contains(self, key):
+        """
+        :return: True if the key is known to be missing
+        """
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+    def stats(self):
+        """
+        :return: A dict with at least the hits, misses, size, false_positive_rate and memory (in bytes) entries
+        """
+        raise NotImplementedError()
+
+
+class LRUNegativeCache(NegativeCache):
+    """
+    A thread-safe exact set of missing ids bounded in size, with an optional time to live. It has no false positive.
+    """
+
+    def __init__(self, maxsize=100000, ttl=60):
+        """
+        :param maxsize: The maximum number of ids kept
+        :param ttl: How long an id is known to be missing, in seconds. None keeps it until evicted
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, key):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = expires
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def contains(self, key):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return False
+            expires = self._data[key]
+            if expires is not None and expires < time.time():
+                del self._data[key]
+                self.misses += 1
+                return False
+            self.hits += 1
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            memory = sys.getsizeof(self._data) + sum(sys.getsizeof(key) for key in self._data)
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._data),
+                'false_positive_rate': 0.0,
+                'memory': memory,
+            }
+
+
+class CountingBloomFilter(NegativeCache):
+    """
+    A thread-safe counting Bloom filter of missing ids, using a fixed amount of memory whatever the ids.
+
+    A false positive hides an existing document, so keep error_rate low. The filter forgets everything every ttl
+    seconds, and once it holds capacity ids, so the false positive rate stays under error_rate.
+    """
+
+    def __init__(self, capacity=100000, error_rate=0.001, ttl=60):
+        """
+        :param capacity: The number of ids held before the filter is reset
+        :param error_rate: The false positive rate at capacity
+        :param ttl: How often the filter is reset, in seconds. None only resets it at capacity
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.ttl = ttl
+        self.bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.bits / float(capacity) * math.log(2))))
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.resets = 0
+        self._reset()
+
+    def _reset(self):
+        self._counters = array('B', [0]) * self.bits
+        self._count = 0
+        self._expires = time.time() + self.ttl if self.ttl is not None else None
+
+    def _positions(self, key):
+        """
+        The counters of a key, by double hashing
+        """
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(repr(key)).digest())
+        return [(h1 + i * h2) % self.bits for i in xrange(self.hashes)]
+
+    def _expire(self):
+        if self._count >= self.capacity or (self._expires is not None and self._expires < time.time()):
+            self._reset()
+            self.resets += 1
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            self._expire()
+            for position in positions:
+                if self._counters[position] < 255:
+                    self._counters[position] += 1
+            self._count += 1
+
+    def discard(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            # Removing a key that was never added would decrement the counters of others
+            if not all(self._counters[position] for position in positions):
+                return
+            for position in positions:
+                # A saturated counter lost track of its keys, it stays set
+                if self._counters[position] < 255:
+                    self._counters[position] -= 1
+            self._count = max(0, self._count - 1)
+
+    def contains(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            self._expire()
+            if all(self._counters[position] for position in positions):
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    def false_positive_rate(self):
+        """
+        :return: The estimated false positive rate for the ids currently held
+        """
+        return (1 - math.exp(-self.hashes * self._count / float(self.bits))) ** self.hashes
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'resets': self.resets,
+                'size': self._count,
+                'false_positive_rate': self.false_positive_rate(),
+                'memory': self._counters.itemsize * len(self._counters),
+            }
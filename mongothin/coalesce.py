@@ -0,0 +1,78 @@
+# coding=utf-8
+
+"""
+Merge concurrent find_one calls into a single $in query
+"""
+
+import threading
+import time
+
+
+class _Batch(object):
+    """
+    The ids requested during one window and their results
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.results = {}
+        self.error = None
+        self.done = threading.Event()
+
+    def add(self, _id):
+        if _id not in self.ids:
+            self.ids.append(_id)
+
+    def run(self, resource):
+        try:
+            # As find_one: its read preference and metrics, and the cache was already checked
+            documents = resource._find_in(self.ids, 'find_one')
+            self.results = dict((document['_id'], document) for document in documents)
+        except Exception as exc:
+            self.error = exc
+        finally:
+            self.done.set()
+
+
+class Coalescer(object):
+    """
+    Coalesce the find_one calls made by concurrent threads (or greenlets) on a Resource.
+
+    The first caller opens a batch and waits for the window to elapse, the callers arriving meanwhile join the batch.
+    The first caller then runs one $in query for the whole batch, with the read preference of find_one, and hands
+    the results back.
+    Callers asking for the same id get the same document, don't mutate it.
+    """
+
+    def __init__(self, resource, window=0.0005):
+        """
+        :param resource: The Resource class to query
+        :param window: How long the batch stays open, in seconds. 0 only yields to the other threads.
+        """
+        self.resource = resource
+        self.window = window
+        self._lock = threading.Lock()
+        self._batch = None
+
+    def find_one(self, doc_id):
+        """ Find one document by id, sharing the round trip with the concurrent callers
+        :param doc_id: The id of the document to find
+        :return: The document or None
+        """
+        _id = self.resource._id_type(doc_id)
+        with self._lock:
+            batch = self._batch
+            leader = batch is None
+            if leader:
+                batch = self._batch = _Batch()
+            batch.add(_id)
+        if leader:
+            time.sleep(self.window)
+            with self._lock:
+                self._batch = None
+            batch.run(self.resource)
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.results.get(_id)
@@ -2,11 +2,18 @@
 
 """This code comes from mongoengine"""
 
+from collections import deque
+import os
+import threading
+import time
+
 import pymongo
 from pymongo import MongoClient, MongoReplicaSetClient, uri_parser
+from pymongo.errors import ConnectionFailure
 
 
-__all__ = ['ConnectionError', 'connect', 'register_connection',
+__all__ = ['ConnectionError', 'CircuitOpenError', 'connect', 'register_connection',
+           'register_circuit_breaker', 'get_circuit_breaker', 'warmup',
            'DEFAULT_CONNECTION_NAME']
 
 DEFAULT_CONNECTION_NAME = 'default'
@@ -16,9 +23,126 @@ class ConnectionError(Exception):
     pass
 
 
+class CircuitOpenError(ConnectionError):
+    """Raised without calling the server while the circuit breaker of an alias is open"""
+    pass
+
+
 _connection_settings = {}
 _connections = {}
 _dbs = {}
+_breakers = {}
+_locks = {}
+_registry_lock = threading.Lock()
+# Clients shared by the aliases with the same settings: {key: [client, number of aliases]}
+_clients = {}
+_client_keys = {}
+_clients_lock = threading.Lock()
+_pid = os.getpid()
+
+
+class CircuitBreaker(object):
+    """Fail fast when a connection keeps failing.
+
+    The breaker is closed as long as the failure rate of the last calls stays
+    under failure_ratio. Then it opens and every call fails with
+    :class:`CircuitOpenError` for reset_timeout seconds. After that it is half
+    open: a single call goes through as a probe, the others keep failing fast
+    until the probe succeeds (closed) or fails (open again).
+
+    Only the connection failures count, any other error shows the server is up. Record only the calls that reached
+    the server: a lazy cursor proves nothing.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    failures = (ConnectionFailure, ConnectionError)
+
+    def __init__(self, alias, failure_ratio=0.5, min_calls=20, window=100,
+                 reset_timeout=30):
+        """
+        :param alias: The connection alias, for the error messages
+        :param failure_ratio: The failure rate opening the breaker
+        :param min_calls: Calls needed in the window before the breaker can open
+        :param window: The number of recent calls considered
+        :param reset_timeout: How long the breaker stays open, in seconds
+        """
+        self.alias = alias
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.opened_at = None
+        self._outcomes = deque(maxlen=window)
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Call before each call to the server.
+
+        :return: True if the call is the probe of a half open breaker, it must
+            then be followed by :meth:`release` whatever happens
+        :raises CircuitOpenError: If the call must not be made
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return False
+            if (self.state == self.OPEN and
+                    time.time() - self.opened_at >= self.reset_timeout):
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+        raise CircuitOpenError('Circuit breaker of "%s" is %s' % (self.alias, self.state))
+
+    def release(self):
+        """Free the probe slot, when the probe was interrupted or didn't
+        reach the server. The next call is the probe.
+        """
+        with self._lock:
+            self._probing = False
+
+    def record(self, error=None):
+        """Record the outcome of a call.
+
+        :param error: The exception raised by the call, None if it succeeded
+        """
+        failed = isinstance(error, self.failures)
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                self._outcomes.clear()
+                if failed:
+                    self._open()
+                else:
+                    self.state = self.CLOSED
+                return
+            self._outcomes.append(failed)
+            if (self.state == self.CLOSED and
+                    len(self._outcomes) >= self.min_calls and
+                    self._outcomes.count(True) >= self.failure_ratio * len(self._outcomes)):
+                self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.time()
+
+
+def register_circuit_breaker(alias, **kwargs):
+    """Add a circuit breaker to a connection alias.
+
+    :param alias: the connection alias
+    :param kwargs: see :class:`CircuitBreaker`
+    """
+    _breakers[alias] = CircuitBreaker(alias, **kwargs)
+    return _breakers[alias]
+
+
+def get_circuit_breaker(alias=DEFAULT_CONNECTION_NAME):
+    """The circuit breaker of an alias, None if it has none"""
+    return _breakers.get(alias)
 
 
 def register_connection(alias, name, host=None, port=None,
@@ -71,78 +195,219 @@ def register_connection(alias, name, host=None, port=None,
     _connection_settings[alias] = conn_settings
 
 
+def _alias_lock(alias):
+    """The lock serializing the creation of the client and db of an alias"""
+    lock = _locks.get(alias)
+    if lock is None:
+        with _registry_lock:
+            lock = _locks.setdefault(alias, threading.RLock())
+    return lock
+
+
+def _check_fork():
+    """Forget the clients inherited from the parent process.
+
+    pymongo clients are not fork-safe: their sockets are shared with the
+    parent and their monitor threads are gone. They are dropped, not closed,
+    so the parent keeps using its sockets.
+    """
+    global _pid, _registry_lock, _clients_lock
+    if os.getpid() != _pid:
+        # The child starts with a single thread, the locks may have been held
+        # by another thread of the parent at fork time
+        _registry_lock = threading.Lock()
+        _clients_lock = threading.Lock()
+        _locks.clear()
+        _clients.clear()
+        _client_keys.clear()
+        _connections.clear()
+        _dbs.clear()
+        _pid = os.getpid()
+
+
 def disconnect(alias=DEFAULT_CONNECTION_NAME):
     global _connections
     global _dbs
 
-    if alias in _connections:
-        get_connection(alias=alias).disconnect()
-        del _connections[alias]
-    if alias in _dbs:
-        del _dbs[alias]
+    _check_fork()
+    with _alias_lock(alias):
+        if alias in _connections:
+            del _connections[alias]
+            _release_client(alias)
+        if alias in _dbs:
+            del _dbs[alias]
 
 
 def get_connection(alias=DEFAULT_CONNECTION_NAME, reconnect=False):
     global _connections
+    _check_fork()
     # Connect to the database if not already connected
     if reconnect:
         disconnect(alias)
 
-    if alias not in _connections:
-        if alias not in _connection_settings:
-            msg = 'Connection with alias "%s" has not been defined' % alias
-            if alias == DEFAULT_CONNECTION_NAME:
-                msg = 'You have not defined a default connection'
-            raise ConnectionError(msg)
-        conn_settings = _connection_settings[alias].copy()
-
-        if hasattr(pymongo, 'version_tuple'):  # Support for 2.1+
-            conn_settings.pop('name', None)
-            conn_settings.pop('slaves', None)
-            conn_settings.pop('is_slave', None)
-            conn_settings.pop('username', None)
-            conn_settings.pop('password', None)
-        else:
-            # Get all the slave connections
-            if 'slaves' in conn_settings:
-                slaves = []
-                for slave_alias in conn_settings['slaves']:
-                    slaves.append(get_connection(slave_alias))
-                conn_settings['slaves'] = slaves
-                conn_settings.pop('read_preference', None)
-
-        connection_class = MongoClient
-        if 'replicaSet' in conn_settings:
-            conn_settings['hosts_or_uri'] = conn_settings.pop('host', None)
-            # Discard port since it can't be used on MongoReplicaSetClient
-            conn_settings.pop('port', None)
-            # Discard replicaSet if not base string
-            if not isinstance(conn_settings['replicaSet'], basestring):
-                conn_settings.pop('replicaSet', None)
-            connection_class = MongoReplicaSetClient
-
-        try:
-            _connections[alias] = connection_class(**conn_settings)
-        except Exception, e:
-            raise ConnectionError("Cannot connect to database %s :\n%s" % (alias, e))
-    return _connections[alias]
+    # A disconnect of another thread can remove the alias at any time, read it once
+    connection = _connections.get(alias)
+    if connection is not None:
+        return connection
+
+    with _alias_lock(alias):
+        connection = _connections.get(alias)
+        if connection is None:
+            connection = _connections[alias] = _acquire_client(alias)
+    return connection
+
+
+def _acquire_client(alias):
+    """Get the client of an alias, shared with the aliases having the same settings.
+
+    Aliases are typically one per database on the same cluster, they share a
+    single client, and its socket pool and monitor threads. Different users
+    get different clients since pymongo authenticates a client per database.
+    """
+    connection_class, conn_settings = _client_settings(alias)
+    key = _client_key(alias, connection_class, conn_settings)
+    with _clients_lock:
+        entry = _clients.get(key)
+        if entry is not None:
+            entry[1] += 1
+            _client_keys[alias] = key
+            return entry[0]
+
+    # Connecting can take up to connectTimeoutMS, don't hold up the other aliases meanwhile
+    try:
+        client = connection_class(**conn_settings)
+    except Exception, e:
+        raise ConnectionError("Cannot connect to database %s :\n%s" % (alias, e))
+    with _clients_lock:
+        entry = _clients.get(key)
+        if entry is None:
+            entry = _clients[key] = [client, 0]
+            client = None
+        entry[1] += 1
+        _client_keys[alias] = key
+    if client is not None:
+        # Another alias connected to the same cluster in the meantime
+        client.disconnect()
+    return entry[0]
+
+
+def _client_key(alias, connection_class, conn_settings):
+    """
+    What makes two aliases need different clients: the cluster, the options and the credentials, but not the
+    database of a URI
+    """
+    settings = dict((name.lower(), value) for name, value in conn_settings.iteritems())
+    host = settings.pop('hosts_or_uri', None) or settings.pop('host', None) or 'localhost'
+    port = settings.pop('port', None) or 27017
+    username = _connection_settings[alias].get('username')
+    auth_source = None
+    if "://" in host:
+        uri = uri_parser.parse_uri(host)
+        nodes = uri['nodelist']
+        settings.update(uri['options'])
+        username = uri['username'] or username
+        auth_source = settings.pop('authsource', None) or (uri['database'] if uri['username'] else None)
+    else:
+        nodes = uri_parser.split_hosts(host, port)
+    return (connection_class.__name__, username, auth_source, tuple(sorted(nodes)),
+            tuple(sorted((name, repr(value)) for name, value in settings.iteritems())))
+
+
+def _release_client(alias):
+    """Disconnect the client of an alias once no other alias uses it"""
+    with _clients_lock:
+        key = _client_keys.pop(alias, None)
+        entry = _clients.get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del _clients[key]
+            entry[0].disconnect()
+
+
+def _client_settings(alias):
+    """
+    :return: The client class and its arguments for an alias
+    """
+    if alias not in _connection_settings:
+        msg = 'Connection with alias "%s" has not been defined' % alias
+        if alias == DEFAULT_CONNECTION_NAME:
+            msg = 'You have not defined a default connection'
+        raise ConnectionError(msg)
+    conn_settings = _connection_settings[alias].copy()
+
+    if hasattr(pymongo, 'version_tuple'):  # Support for 2.1+
+        conn_settings.pop('name', None)
+        conn_settings.pop('slaves', None)
+        conn_settings.pop('is_slave', None)
+        conn_settings.pop('username', None)
+        conn_settings.pop('password', None)
+    else:
+        # Get all the slave connections
+        if 'slaves' in conn_settings:
+            slaves = []
+            for slave_alias in conn_settings['slaves']:
+                slaves.append(get_connection(slave_alias))
+            conn_settings['slaves'] = slaves
+            conn_settings.pop('read_preference', None)
+
+    connection_class = MongoClient
+    if 'replicaSet' in conn_settings:
+        conn_settings['hosts_or_uri'] = conn_settings.pop('host', None)
+        # Discard port since it can't be used on MongoReplicaSetClient
+        conn_settings.pop('port', None)
+        # Discard replicaSet if not base string
+        if not isinstance(conn_settings['replicaSet'], basestring):
+            conn_settings.pop('replicaSet', None)
+        connection_class = MongoReplicaSetClient
+
+    return connection_class, conn_settings
 
 
 def get_db(alias=DEFAULT_CONNECTION_NAME, reconnect=False):
     global _dbs
+    _check_fork()
     if reconnect:
         disconnect(alias)
 
-    if alias not in _dbs:
-        conn = get_connection(alias)
-        conn_settings = _connection_settings[alias]
-        db = conn[conn_settings['name']]
-        # Authenticate if necessary
-        if conn_settings['username'] and conn_settings['password']:
-            db.authenticate(conn_settings['username'],
-                            conn_settings['password'])
-        _dbs[alias] = db
-    return _dbs[alias]
+    db = _dbs.get(alias)
+    if db is not None:
+        return db
+
+    with _alias_lock(alias):
+        db = _dbs.get(alias)
+        if db is None:
+            conn = get_connection(alias)
+            conn_settings = _connection_settings[alias]
+            db = conn[conn_settings['name']]
+            # Authenticate if necessary
+            if conn_settings['username'] and conn_settings['password']:
+                db.authenticate(conn_settings['username'],
+                                conn_settings['password'])
+            _dbs[alias] = db
+    return db
+
+
+def warmup(aliases=None, min_connections=1):
+    """Connect, authenticate and open sockets before the first request.
+
+    Call it at boot, after the fork when running under a pre-forking server.
+
+    :param aliases: the aliases to warm up, all the registered ones by default
+    :param min_connections: the number of sockets to open per alias. They are
+        opened by as many concurrent pings, the pool keeps them afterwards.
+    """
+    if aliases is None:
+        aliases = _connection_settings.keys()
+    for alias in aliases:
+        db = get_db(alias)
+        threads = [threading.Thread(target=db.command, args=('ping',))
+                   for _ in xrange(0, min_connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
 
 def connect(db, alias=DEFAULT_CONNECTION_NAME, **kwargs):
@@ -0,0 +1,237 @@
+# coding=utf-8
+
+"""
+Tell the other processes which documents were written so they evict them from their Resource caches
+"""
+
+import errno
+import glob
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from bson import BSON
+
+
+log = logging.getLogger(__name__)
+
+# Only taken in forked children, so never held by another thread at fork time
+_fork_lock = threading.Lock()
+
+
+class Transport(object):
+    """
+    Carries the invalidation events between processes. Events are dicts of BSON-encodable values.
+    Implement it for an external broker, or by tailing a change stream and calling the callbacks.
+    """
+
+    def publish(self, event):
+        raise NotImplementedError()
+
+    def subscribe(self, callback):
+        """
+        :param callback: Called with each event received
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def after_fork(self):
+        """
+        Called in a forked child before it subscribes again, to drop what belongs to the parent
+        """
+        pass
+
+
+class LocalTransport(Transport):
+    """
+    Delivers the events to the subscribers of the same process, for tests
+    """
+
+    def __init__(self):
+        self.callbacks = []
+
+    def publish(self, event):
+        for callback in self.callbacks:
+            callback(event)
+
+    def subscribe(self, callback):
+        if callback not in self.callbacks:
+            self.callbacks.append(callback)
+
+
+class UnixSocketTransport(Transport):
+    """
+    Delivers the events to the processes of the same host. Each subscribed process binds a datagram socket in
+    directory and the events are sent to all of them. The sockets of dead processes are removed when found.
+
+    Sending never blocks the write publishing the event: when the socket of a process is full, because it is paused
+    or stalled, the event is dropped for that process and counted in dropped.
+
+    The list of the sockets is kept between events and listed again every peers_ttl seconds, or when one is gone.
+    A process starting receives the events at most peers_ttl seconds later, its cache is empty meanwhile.
+    """
+
+    def __init__(self, directory, peers_ttl=1.0):
+        """
+        :param directory: A directory shared by the processes
+        :param peers_ttl: How long the list of the sockets is used, in seconds
+        """
+        self.directory = directory
+        self.peers_ttl = peers_ttl
+        self.path = None
+        self.dropped = 0
+        self._socket = self._sender()
+        self._thread = None
+        self._peers = None
+        self._peers_listed = 0
+
+    @staticmethod
+    def _sender():
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+        return sender
+
+    def _get_peers(self):
+        now = time.time()
+        peers = self._peers
+        if peers is None or now - self._peers_listed > self.peers_ttl:
+            peers = [path for path in glob.glob(os.path.join(self.directory, '*.sock')) if path != self.path]
+            self._peers, self._peers_listed = peers, now
+        return peers
+
+    def publish(self, event):
+        data = BSON.encode(event)
+        for path in self._get_peers():
+            try:
+                self._socket.sendto(data, path)
+            except socket.error as exc:
+                if exc.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    self._remove(path)
+                    self._peers = None
+                elif exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    self.dropped += 1
+                    log.debug("Invalidation dropped, %s is full" % path)
+                else:
+                    log.warning("Can't send invalidation to %s: %s" % (path, exc))
+
+    def subscribe(self, callback):
+        self.path = os.path.join(self.directory, '%d-%s.sock' % (os.getpid(), uuid.uuid4().hex[:8]))
+        self._peers = None
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(self.path)
+        self._thread = threading.Thread(target=self._receive, args=(receiver, callback),
+                                        name='mongothin-invalidation')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _receive(self, receiver, callback):
+        while True:
+            try:
+                data = receiver.recv(65536)
+            except socket.error:
+                return
+            try:
+                callback(BSON(data).decode())
+            except Exception as exc:
+                log.warning("Can't handle invalidation: %s" % exc)
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def close(self):
+        if self.path is not None:
+            self._remove(self.path)
+            self.path = None
+
+    def after_fork(self):
+        # The socket file and the receiving thread are the parent's
+        self.path = None
+        self._thread = None
+        self._socket = self._sender()
+        self._peers = None
+
+
+class InvalidationBus(object):
+    """
+    Publishes an event for each document written by a Resource and evicts the documents written by the other
+    processes from the caches of the local Resources.
+
+        >>> bus = InvalidationBus(UnixSocketTransport('/var/run/myapp'))
+        >>> class UserResource(Resource):
+        >>>     _cache = LRUCache(maxsize=10000)
+        >>>     _invalidation_bus = bus
+        >>> bus.register(UserResource)
+
+    Resources register on their first write, register the read-only ones explicitly.
+
+    A bus created before a fork subscribes again in the child, with its own origin, on its first use there.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self._resources = {}
+        self._lock = threading.Lock()
+        self.published = 0
+        self.received = 0
+        self._subscribe()
+
+    def _subscribe(self):
+        self._pid = os.getpid()
+        self.origin = '%d-%s' % (self._pid, uuid.uuid4().hex)
+        self.transport.subscribe(self._receive)
+
+    def check_fork(self):
+        """
+        Subscribe again when running in a process forked since the last call. Resources call it before using their
+        cache.
+        """
+        if os.getpid() != self._pid:
+            with _fork_lock:
+                if os.getpid() != self._pid:
+                    # Another thread of the parent may have held it at fork time
+                    self._lock = threading.Lock()
+                    self.transport.after_fork()
+                    self._subscribe()
+
+    def register(self, *resources):
+        """
+        Evict the documents of these Resources when their collection is written by another process
+        """
+        with self._lock:
+            for resource in resources:
+                registered = self._resources.setdefault((resource._alias, resource._collection), [])
+                if resource not in registered:
+                    registered.append(resource)
+
+    def publish(self, resource, _id, shard=None):
+        """
+        :param resource: The Resource class written
+        :param _id: The coerced _id of the document written, None if unknown
+        :param shard: The shard key value of the document
+        """
+        self.check_fork()
+        self.register(resource)
+        self.published += 1
+        self.transport.publish({
+            'origin': self.origin,
+            'resource': resource.__name__,
+            'alias': resource._alias,
+            'collection': resource._collection,
+            '_id': _id,
+            'shard': shard,
+        })
+
+    def _receive(self, event):
+        if event.get('origin') == self.origin:
+            return
+        self.received += 1
+        for resource in self._resources.get((event['alias'], event['collection']), ()):
+            resource._evict(event['_id'])
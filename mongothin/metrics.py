@@ -0,0 +1,151 @@
+# coding=utf-8
+
+"""
+Per Resource and per operation call metrics.
+
+Disabled by default, enable with:
+
+    >>> from mongothin.metrics import registry
+    >>> registry.enabled = True
+
+Then read them with :method:MetricsRegistry.snapshot or push them with :method:MetricsRegistry.export
+"""
+
+from bisect import bisect_left
+import threading
+
+
+# Upper bounds of the latency buckets, in seconds. The last bucket counts everything above.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class OperationMetrics(object):
+    """
+    The counters of one operation of one Resource. The histogram is preallocated so recording doesn't allocate.
+
+    Recording takes no lock: it runs on every call, and the rare increment lost when two threads record at the same
+    time is an acceptable error for metrics.
+    """
+
+    __slots__ = ('buckets', 'errors', 'retries', 'slept', 'latency', 'histogram')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        self.errors = 0
+        self.retries = 0
+        self.slept = 0.0
+        self.latency = 0.0
+        self.histogram = [0] * (len(self.buckets) + 1)
+
+    @property
+    def calls(self):
+        return sum(self.histogram)
+
+    def record(self, latency, retries, slept, failed):
+        self.latency += latency
+        self.histogram[bisect_left(self.buckets, latency)] += 1
+        if retries or failed:
+            self.errors += failed
+            self.retries += retries
+            self.slept += slept
+
+    def percentile(self, ratio):
+        """
+        :param ratio: Between 0 and 1
+        :return: The upper bound of the bucket holding this percentile, None if it is the overflow bucket or no call
+        """
+        rank = ratio * sum(self.histogram)
+        seen = 0
+        for i, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else None
+        return None
+
+    def snapshot(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'retries': self.retries,
+            'slept': self.slept,
+            'latency': self.latency,
+            'histogram': list(self.histogram),
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+        }
+
+
+class MetricsRegistry(object):
+    """
+    Holds the OperationMetrics of all the Resources using it, in operations: {(resource, operation): OperationMetrics}
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, enabled=False):
+        self.buckets = buckets
+        self.enabled = enabled
+        self.operations = {}
+        self._exporters = []
+        self._lock = threading.Lock()
+
+    def get(self, resource, operation):
+        """
+        :param resource: The Resource name
+        :param operation: The operation name
+        :rtype: OperationMetrics
+        """
+        key = (resource, operation)
+        metrics = self.operations.get(key)
+        if metrics is None:
+            with self._lock:
+                metrics = self.operations.setdefault(key, OperationMetrics(self.buckets))
+        return metrics
+
+    def record(self, resource, operation, latency, retries=0, slept=0.0, failed=False):
+        """
+        Record one call
+        :param latency: The duration of the call, retries included, in seconds
+        :param retries: The number of retries made
+        :param slept: The time spent in backoff, in seconds
+        :param failed: If the call raised
+        """
+        self.get(resource, operation).record(latency, retries, slept, failed)
+
+    def snapshot(self):
+        """
+        :return: {resource: {operation: {counter: value}}}
+        """
+        snapshot = {}
+        for (resource, operation), metrics in self.operations.items():
+            snapshot.setdefault(resource, {})[operation] = metrics.snapshot()
+        return snapshot
+
+    def reset(self):
+        for metrics in self.operations.values():
+            metrics.reset()
+
+    def add_exporter(self, exporter):
+        """
+        :param exporter: A callable taking a snapshot, called by :method:export
+        """
+        self._exporters.append(exporter)
+
+    def remove_exporter(self, exporter):
+        self._exporters.remove(exporter)
+
+    def export(self, reset=False):
+        """
+        Push a snapshot to all the exporters. Call it periodically from your own scheduler.
+        :param reset: Reset the counters once exported, to export deltas
+        """
+        snapshot = self.snapshot()
+        if reset:
+            self.reset()
+        for exporter in self._exporters:
+            exporter(snapshot)
+        return snapshot
+
+
+registry = MetricsRegistry()
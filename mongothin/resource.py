@@ -4,12 +4,26 @@
 The main ressource object
 """
 
+import itertools
 import logging
-from bson import ObjectId
-from pymongo.errors import AutoReconnect
+import threading
+from bson import BSON, ObjectId
+import pymongo
+from pymongo.cursor import Cursor
+from pymongo.errors import DuplicateKeyError
+try:
+    from bson.codec_options import CodecOptions
+    from bson.raw_bson import RawBSONDocument
+except ImportError:  # pymongo < 3
+    CodecOptions = RawBSONDocument = None
 import time
-from mongothin import raw_updater, default_updater
-from mongothin.connection import DEFAULT_CONNECTION_NAME, get_db
+from mongothin import raw_updater, default_updater, inc_updater
+from mongothin.cache import get_generations
+from mongothin.coalesce import Coalescer
+from mongothin.connection import DEFAULT_CONNECTION_NAME, get_circuit_breaker, get_db
+from mongothin.metrics import registry
+from mongothin.retry import RetryPolicy
+from mongothin.scan import scan
 
 
 class ResourceMeta(type):
@@ -31,6 +45,99 @@ class MissingIdsException(Exception):
     pass
 
 
+# The name of the projection parameter of find
+PROJECTION = 'projection' if pymongo.version_tuple[0] >= 3 else 'fields'
+
+# pymongo 3+ takes the read preference from the collection, see :method:Resource._get_handle
+WITH_OPTIONS = pymongo.version_tuple[0] >= 3
+
+# The _read_preference entry used by the operations without their own
+READ_PREFERENCE_OPERATIONS = {
+    'resolve': 'find_in',
+    'iter_resolve': 'find_in',
+    'existing_ids': 'find_in',
+    'parallel_scan': 'iter_all',
+}
+
+# Ids per $in query in resolve
+RESOLVE_CHUNK_SIZE = 1000
+
+# Keep bulk batches well under the 48MB wire message limit
+BULK_CHUNK_SIZE = 1000
+BULK_MAX_BYTES = 16 * 1024 * 1024
+
+
+class _RecordedCursor(object):
+    """
+    Mixed in the cursors returned by :method:Resource._make_call_as when _metrics or _sampler are on. A cursor only
+    queries the server once iterated, so its call is recorded when it is exhausted, fails, is closed or is collected,
+    with the time spent creating it and fetching its batches. The time the caller spends between batches doesn't count.
+    """
+
+    def _refresh(self):
+        started = time.time()
+        try:
+            count = super(_RecordedCursor, self)._refresh()
+        except Exception:
+            self._fetch_time += time.time() - started
+            self._record(True)
+            raise
+        self._fetch_time += time.time() - started
+        if not count:
+            self._record(False)
+        return count
+
+    def close(self):
+        super(_RecordedCursor, self).close()
+        self._record(False)
+
+    def __del__(self):
+        self._record(False)
+        super(_RecordedCursor, self).__del__()
+
+    def _record(self, failed):
+        on_done = self.__dict__.pop('_on_done', None)
+        if on_done is not None:
+            on_done(self._fetch_time, failed)
+
+
+_recorded_cursor_classes = {}
+
+
+def _recorded_cursor_class(cursor_class):
+    """
+    :return: The subclass of cursor_class with :class:_RecordedCursor mixed in
+    """
+    recorded_class = _recorded_cursor_classes.get(cursor_class)
+    if recorded_class is None:
+        recorded_class = _recorded_cursor_classes.setdefault(
+            cursor_class, type('Recorded%s' % cursor_class.__name__, (_RecordedCursor, cursor_class), {}))
+    return recorded_class
+
+
+def chunk_documents(documents, chunk_size=BULK_CHUNK_SIZE, max_bytes=BULK_MAX_BYTES):
+    """
+    Split documents in chunks bounded by both the number of documents and their encoded BSON size.
+    A document bigger than max_bytes gets its own chunk, the server will reject it if it's really too big.
+    :param documents: An iterable of documents
+    :param chunk_size: Maximum number of documents per chunk
+    :param max_bytes: Maximum encoded BSON size of a chunk
+    :return: A generator of lists of documents
+    """
+    chunk = []
+    chunk_bytes = 0
+    for document in documents:
+        size = len(BSON.encode(document))
+        if chunk and (len(chunk) >= chunk_size or chunk_bytes + size > max_bytes):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(document)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
 class Resource(object):
     """
     A Resource is a small wrapper around pymongo allowing you do write this:
@@ -59,10 +166,37 @@ class Resource(object):
         >>>     _retries = 2
         >>>     # Exponential backoff base
         >>>     _delay = 0.01
+        >>>     # Or a full retry policy with jitter, a retry budget shared by the alias and deadlines, see :class:RetryPolicy
+        >>>     _retry_policy = None
+        >>>     # Where the calls are recorded, see :module:mongothin.metrics. None disables it
+        >>>     _metrics = registry
+        >>>     # Log and aggregate the slow calls, see :class:SlowQuerySampler
+        >>>     _sampler = SlowQuerySampler(threshold=0.1, explain_rate=0.01)
+        >>>     # Read preference per method (find_one, find, find_in, iter_all). resolve, exists and existing_ids use the
+        >>>     # find_in one, parallel_scan the iter_all one. Pass read_preference to a call to override it (pymongo 2.x)
+        >>>     _read_preference = {'find': ReadPreference.SECONDARY_PREFERRED, 'find_one': ReadPreference.PRIMARY}
+        >>>     # Only read from the secondaries within this latency of the nearest one, in ms
+        >>>     _secondary_latency_ms = None
+        >>>     # Projection used by find_one, find, find_in and resolve when the call doesn't give one. The _id, and
+        >>>     # the sort_key of iter_all, are always returned
+        >>>     _default_fields = None
+        >>>     # Return read-only RawBSONDocuments decoding their fields on access (pymongo 3+)
+        >>>     _lazy = False
         >>>     # Collection. If not specified the name of the class is used.
         >>>     _collection = 'user'
         >>>     # Shard info. Make sure the query contains the shard info
         >>>     _shard = (sharder_function, field,)
+        >>>     # Merge the concurrent find_one calls by id made within this window (in seconds) in one query
+        >>>     _coalesce = None
+        >>>     # Read-through cache for the lookups by id, see :module:mongothin.cache. Writes invalidate it.
+        >>>     _cache = LRUCache(maxsize=10000, ttl=60)
+        >>>     # The ids find_one and resolve recently found missing, answered without a query. Writes clear them.
+        >>>     # See :class:LRUNegativeCache and :class:CountingBloomFilter
+        >>>     _negative_cache = None
+        >>>     # Evict the documents written by the other processes from the cache, see :class:InvalidationBus
+        >>>     _invalidation_bus = None
+        >>>     # Buffer the update_dict and inc_dict calls and write them in bulk, see :class:WriteBehindBuffer
+        >>>     _write_behind = None
 
     """
 
@@ -74,9 +208,165 @@ class Resource(object):
 
     _retries = 0
     _delay = 0.01
+    _retry_policy = None
+
+    _metrics = registry
+    _sampler = None
+
+    _read_preference = None
+    _secondary_latency_ms = None
+
+    _default_fields = None
+    _lazy = False
 
     _shard = None
 
+    _coalesce = None
+
+    _cache = None
+    _negative_cache = None
+    _invalidation_bus = None
+
+    _write_behind = None
+
+    _lazy_lock = threading.Lock()
+
+    @classmethod
+    def _get_lazy(cls, name, factory):
+        """
+        Get a helper object stored on this class, created on first use so subclasses don't share it
+        :param name: The class attribute holding the object
+        :param factory: Called without arguments to create the object
+        """
+        value = cls.__dict__.get(name)
+        if value is None:
+            with cls._lazy_lock:
+                value = cls.__dict__.get(name)
+                if value is None:
+                    value = factory()
+                    setattr(cls, name, value)
+        return value
+
+    @classmethod
+    def _get_coalescer(cls):
+        return cls._get_lazy('_coalescer', lambda: Coalescer(cls, cls._coalesce))
+
+    @classmethod
+    def _invalidate(cls, doc_id):
+        """
+        Drop a written document from the cache, and from the caches of the other processes when there is an
+        _invalidation_bus.
+        """
+        cls._evict(doc_id)
+        if cls._invalidation_bus is not None:
+            _id = cls._id_type(doc_id) if doc_id else None
+            shard = cls._add_shard({'_id': _id}).get(cls._shard[1]) if cls._shard and _id else None
+            cls._invalidation_bus.publish(cls, _id, shard)
+
+    @classmethod
+    def _get_cache(cls):
+        """
+        The cache, once the invalidation bus listens in this process, see :method:InvalidationBus.check_fork
+        """
+        if cls._invalidation_bus is not None:
+            cls._invalidation_bus.check_fork()
+        return cls._cache
+
+    @classmethod
+    def _get_generations(cls):
+        """
+        The invalidation counters of the ids, kept with the cache, see :class:Generations
+        """
+        return get_generations(cls._cache if cls._cache is not None else cls._negative_cache)
+
+    @classmethod
+    def _evict(cls, doc_id):
+        """
+        Drop a document from the cache and the id from the negative cache. Without doc_id we don't know what changed
+        so both are dropped. The generation of the id is bumped first, so a read in flight doesn't cache it again.
+        """
+        if cls._cache is None and cls._negative_cache is None:
+            return
+        if doc_id:
+            cls._get_generations().bump(cls._id_type(doc_id))
+        else:
+            cls._get_generations().bump_all()
+        for cache in (cls._cache, cls._negative_cache):
+            if cache is None:
+                continue
+            if not doc_id:
+                cache.clear()
+            elif cache is cls._cache:
+                cache.delete(cls._id_type(doc_id))
+            else:
+                cache.discard(cls._id_type(doc_id))
+
+    @classmethod
+    def _fill(cls, generations, _id, document, generation):
+        """
+        Cache a document read, or the absence of its id when document is None, unless the id was invalidated since
+        generation was taken, before the read. An invalidation racing the fill drops the entry again.
+        """
+        if generations.get(_id) != generation:
+            return
+        if document is None:
+            if cls._negative_cache is not None:
+                cls._negative_cache.add(_id)
+                if generations.get(_id) != generation:
+                    cls._negative_cache.discard(_id)
+        elif cls._cache is not None:
+            cls._cache.set(_id, document)
+            if generations.get(_id) != generation:
+                cls._cache.delete(_id)
+
+    @classmethod
+    def _find_options(cls, operation, args, kwargs, sort_key='_id'):
+        """
+        Add the default projection and the read preference of an operation to the driver keyword parameters,
+        unless the call sets its own. On pymongo 3+ the read preference is set on the collection, see :method:_get_handle
+        :param operation: The Resource method name
+        :param args: The driver positional parameters of the call, the first one is the projection
+        :param kwargs: The driver keyword parameters of the call, not modified
+        :param sort_key: The field the results are paged on, kept in the default projection
+        :return: The keyword parameters to use
+        """
+        if cls._default_fields is not None and not args and 'fields' not in kwargs and 'projection' not in kwargs:
+            kwargs = dict(kwargs)
+            kwargs[PROJECTION] = cls._default_projection(sort_key)
+        if WITH_OPTIONS or not cls._read_preference or 'read_preference' in kwargs:
+            return kwargs
+        read_preference = cls._read_preference.get(READ_PREFERENCE_OPERATIONS.get(operation, operation))
+        if read_preference is None:
+            return kwargs
+        kwargs = dict(kwargs, read_preference=read_preference)
+        if cls._secondary_latency_ms is not None:
+            kwargs.setdefault('secondary_acceptable_latency_ms', cls._secondary_latency_ms)
+        return kwargs
+
+    @classmethod
+    def _default_projection(cls, sort_key):
+        """
+        _default_fields, with the _id the cache is keyed on and the sort_key iter_all pages on
+        """
+        projections = cls._get_lazy('_default_projections', dict)
+        projection = projections.get(sort_key)
+        if projection is None:
+            if isinstance(cls._default_fields, dict):
+                projection = dict(cls._default_fields)
+                for key in ('_id', sort_key):
+                    if key in projection and not projection[key]:
+                        del projection[key]
+                # An inclusion projection, {'name': 1}, needs the sort_key. The _id is returned unless excluded
+                including = any(value and not isinstance(value, dict) for value in projection.itervalues())
+                if including and sort_key != '_id':
+                    projection[sort_key] = 1
+            else:
+                projection = list(cls._default_fields)
+                if sort_key not in projection:
+                    projection.append(sort_key)
+            projections[sort_key] = projection
+        return projection
+
     @classmethod
     def _make_specs(cls, doc_id=None, specs=None):
         """
@@ -117,16 +407,179 @@ class Resource(object):
         collection = cls._get_db()[getattr(cls, '_collection')]
         return collection
 
+    @classmethod
+    def _get_dispatch(cls):
+        """
+        The collection of this class, its bound methods and its handles per operation, resolved once per database
+        object. A disconnect or a reconnect replaces the database object, which rebuilds the table.
+        :return: A tuple (db, collection, {(method name, operation): bound method}, {operation: collection})
+        """
+        db = cls._get_db()
+        dispatch = cls.__dict__.get('_dispatch')
+        if dispatch is None or dispatch[0] is not db:
+            collection = db[cls._collection]
+            if cls._lazy:
+                collection = cls._lazy_collection(collection)
+            dispatch = (db, collection, {}, {})
+            cls._dispatch = dispatch
+        return dispatch
+
+    @classmethod
+    def _lazy_collection(cls, collection):
+        """
+        The collection returning RawBSONDocuments, which decode their fields on access
+        """
+        if RawBSONDocument is None or not hasattr(collection, 'with_options'):
+            cls.log.warning("Lazy documents need pymongo 3+, documents are decoded")
+            return collection
+        return collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+
+    @classmethod
+    def _get_method(cls, function, operation=None):
+        methods = cls._get_dispatch()[2]
+        key = (function, operation)
+        method = methods.get(key)
+        if method is None:
+            method = methods[key] = getattr(cls._get_handle(operation), function)
+        return method
+
+    @classmethod
+    def _get_handle(cls, operation):
+        """
+        The collection an operation runs on. On pymongo 3+ it carries the read preference of the operation, the
+        driver doesn't take it as a parameter anymore. _secondary_latency_ms is then a client setting
+        (localThresholdMS).
+        """
+        _, collection, _, handles = cls._get_dispatch()
+        handle = handles.get(operation)
+        if handle is None:
+            name = READ_PREFERENCE_OPERATIONS.get(operation, operation)
+            handle = handles.get(name)
+            if handle is None:
+                read_preference = None
+                if WITH_OPTIONS and cls._read_preference and name is not None:
+                    read_preference = cls._read_preference.get(name)
+                if read_preference is not None:
+                    handle = collection.with_options(read_preference=read_preference)
+                else:
+                    handle = collection
+                handles[name] = handle
+            handles[operation] = handle
+        return handle
+
+    @classmethod
+    def _get_retry_policy(cls):
+        if cls._retry_policy is not None:
+            return cls._retry_policy
+        # Rebuilt when _retries or _delay change, they are read on every call
+        policy = cls.__dict__.get('_default_retry_policy')
+        if policy is None or policy.retries != cls._retries or policy.delay != cls._delay:
+            policy = RetryPolicy(cls._retries, cls._delay)
+            cls._default_retry_policy = policy
+        return policy
+
     @classmethod
     def _make_call(cls, function, *args, **kwargs):
-        for n in xrange(0, cls._retries + 1):
+        """
+        Call a collection method with retries and exponential backoff, see :method:_make_call_as.
+        The call is recorded under the name of the function.
+        """
+        return cls._make_call_as(None, function, *args, **kwargs)
+
+    @classmethod
+    def _make_call_as(cls, operation, function, *args, **kwargs):
+        """
+        Call a collection method with retries and exponential backoff, see :class:RetryPolicy.
+        Fails fast when the circuit breaker of the alias is open, see :function:connection.register_circuit_breaker
+        :param operation: The Resource operation the call is recorded as by _metrics and _sampler.
+            None uses the name of the function. A call returning a cursor is recorded once the cursor is done, see
+            :class:_RecordedCursor
+        :param function: The name of the collection method, or a callable taking the collection as first argument
+        :param args: Passed to the function
+        :param kwargs: Passed to the function
+        """
+        policy = cls._get_retry_policy()
+        budget = policy.budget(cls._alias)
+        if budget is not None:
+            budget.deposit()
+        breaker = get_circuit_breaker(cls._alias)
+        metrics = cls._metrics
+        if metrics is not None and not metrics.enabled:
+            metrics = None
+        sampler = cls._sampler
+        started = time.time()
+        slept = 0
+        n = 0
+        while True:
+            probe = breaker is not None and breaker.acquire()
             try:
-                collection = cls._get_collection()
-                function = getattr(collection, function)
-                return function(*args, **kwargs)
-            except AutoReconnect:
-                time.sleep(cls._delay * (2 ** n))
-        raise
+                if callable(function):
+                    result = function(cls._get_handle(operation), *args, **kwargs)
+                else:
+                    result = cls._get_method(function, operation)(*args, **kwargs)
+            except Exception as exc:
+                if breaker is not None:
+                    breaker.record(exc)
+                delay = None
+                if isinstance(exc, policy.retryable):
+                    delay = policy.backoff(n, started, budget)
+                if delay is None:
+                    if metrics is not None or sampler is not None:
+                        cls._record_call(metrics, sampler, operation, function, args, time.time() - started, n,
+                                         slept, True)
+                    raise
+                time.sleep(delay)
+                slept += delay
+                n += 1
+            else:
+                # A cursor is lazy, the server hasn't been reached yet
+                lazy = isinstance(result, Cursor)
+                if breaker is not None and not lazy:
+                    breaker.record()
+                if policy.deadline is not None and lazy:
+                    # Let the server give up when the caller would
+                    result.max_time_ms(max(1, int(policy.remaining(started) * 1000)))
+                if lazy:
+                    if metrics is not None or sampler is not None:
+                        cls._record_cursor(result, metrics, sampler, operation, function, args, started, n, slept)
+                elif sampler is None and metrics is not None and operation is not None:
+                    # The common case, what _record_call does in a lookup and a call
+                    operation_metrics = metrics.operations.get((cls.__name__, operation))
+                    if operation_metrics is None:
+                        operation_metrics = metrics.get(cls.__name__, operation)
+                    operation_metrics.record(time.time() - started, n, slept, False)
+                elif metrics is not None or sampler is not None:
+                    cls._record_call(metrics, sampler, operation, function, args, time.time() - started, n, slept,
+                                     False)
+                return result
+            finally:
+                if probe:
+                    breaker.release()
+
+    @classmethod
+    def _record_call(cls, metrics, sampler, operation, function, args, duration, retries, slept, failed):
+        """
+        Record a call in the enabled metrics registry and the sampler, either can be None
+        """
+        if operation is None:
+            operation = function if isinstance(function, basestring) else function.__name__
+        if metrics is not None:
+            operation_metrics = metrics.operations.get((cls.__name__, operation))
+            if operation_metrics is None:
+                operation_metrics = metrics.get(cls.__name__, operation)
+            operation_metrics.record(duration, retries, slept, failed)
+        if sampler is not None:
+            sampler.sample(cls, operation, args, duration, retries)
+
+    @classmethod
+    def _record_cursor(cls, cursor, metrics, sampler, operation, function, args, started, retries, slept):
+        """
+        Record the call that returned a cursor once the cursor is done, see :class:_RecordedCursor
+        """
+        cursor.__class__ = _recorded_cursor_class(cursor.__class__)
+        cursor._fetch_time = time.time() - started
+        cursor._on_done = lambda duration, failed: cls._record_call(metrics, sampler, operation, function, args,
+                                                                    duration, retries, slept, failed)
 
     @classmethod
     def insert(cls, document, doc_id=None):
@@ -144,9 +597,118 @@ class Resource(object):
         document['_id'] = doc_id
         cls._add_shard(document)
 
-        cls._make_call('insert', document)
+        cls._make_call_as('insert', 'insert', document)
+        cls._invalidate(doc_id)
         return doc_id
 
+    @classmethod
+    def _prepare_bulk(cls, documents):
+        """
+        Generate the missing _id and add the shard information, the same way :method:insert does
+        """
+        for document in documents:
+            if not document.get('_id'):
+                document['_id'] = ObjectId()
+            cls._add_shard(document)
+            yield document
+
+    @classmethod
+    def _bulk_write(cls, operation, function, documents, ordered, chunk_size, max_bytes):
+        """
+        Send the documents chunk by chunk. Each chunk goes through :method:_make_call_as so only a failed chunk is
+        retried.
+        :return: A tuple (ids, errors). ids are the _id of the documents in the chunks that succeeded,
+            errors a list of {'ids': [...], 'error': exception} for the chunks that failed. When ordered, the chunks
+            after the first failure are not sent and reported with a None error.
+        """
+        ids = []
+        errors = []
+        failed = False
+        for chunk in chunk_documents(cls._prepare_bulk(documents), chunk_size, max_bytes):
+            chunk_ids = [document['_id'] for document in chunk]
+            if failed:
+                errors.append({'ids': chunk_ids, 'error': None})
+                continue
+            try:
+                cls._make_call_as(operation, function, chunk, ordered, [])
+            except Exception as exc:
+                cls.log.warning("Bulk write of %d documents failed: %s" % (len(chunk), exc))
+                errors.append({'ids': chunk_ids, 'error': exc})
+                failed = ordered
+            else:
+                ids.extend(chunk_ids)
+            finally:
+                for _id in chunk_ids:
+                    cls._invalidate(_id)
+        return ids, errors
+
+    @classmethod
+    def _insert_chunk(cls, collection, chunk, ordered, attempts):
+        """
+        :param attempts: A list shared by the attempts of the chunk, to tell a retry
+        """
+        attempts.append(None)
+        if len(attempts) == 1:
+            return collection.insert(chunk, continue_on_error=not ordered)
+
+        # The failed attempt may have written part of the chunk. Its documents are stored as they were sent, the
+        # other ones with the same _id were already there and are reported as duplicates, as they were the first time
+        ids = [document['_id'] for document in chunk]
+        specs = cls._shard_spec(ids) if cls._shard else {'_id': {'$in': ids}}
+        stored = dict((document['_id'], document) for document in collection.find(specs))
+        missing = []
+        duplicates = []
+        for document in chunk:
+            if document['_id'] not in stored:
+                missing.append(document)
+            elif stored[document['_id']] != document:
+                duplicates.append(document['_id'])
+                if ordered:
+                    break
+        if missing:
+            collection.insert(missing, continue_on_error=not ordered)
+        if duplicates:
+            raise DuplicateKeyError("Already in %s: %s" % (cls._collection, duplicates), 11000)
+
+    @classmethod
+    def _upsert_chunk(cls, collection, chunk, ordered, attempts):
+        if ordered:
+            bulk = collection.initialize_ordered_bulk_op()
+        else:
+            bulk = collection.initialize_unordered_bulk_op()
+        for document in chunk:
+            specs = {'_id': document['_id']}
+            if cls._shard and cls._shard[1] in document:
+                specs[cls._shard[1]] = document[cls._shard[1]]
+            bulk.find(specs).upsert().replace_one(document)
+        return bulk.execute()
+
+    @classmethod
+    def insert_many(cls, documents, ordered=False, chunk_size=BULK_CHUNK_SIZE, max_bytes=BULK_MAX_BYTES):
+        """
+        Insert several documents in as few round trips as possible.
+        Documents without an _id get an ObjectId, the shard information is added to all of them.
+        :param documents: An iterable of documents to insert
+        :param ordered: Stop at the first error instead of inserting as much as possible
+        :param chunk_size: Maximum number of documents sent in one call
+        :param max_bytes: Maximum encoded BSON size sent in one call
+        :return: A tuple (ids, errors), see :method:_bulk_write
+        """
+        return cls._bulk_write('insert_many', cls._insert_chunk, documents, ordered, chunk_size, max_bytes)
+
+    @classmethod
+    def upsert_many(cls, documents, ordered=False, chunk_size=BULK_CHUNK_SIZE, max_bytes=BULK_MAX_BYTES):
+        """
+        Insert or replace several documents by _id in as few round trips as possible.
+        Documents without an _id get an ObjectId, the shard information is added to all of them.
+        :param documents: An iterable of documents to upsert
+        :param ordered: Stop at the first error instead of writing as much as possible
+        :param chunk_size: Maximum number of documents sent in one call
+        :param max_bytes: Maximum encoded BSON size sent in one call
+        :return: A tuple (ids, errors), see :method:_bulk_write
+        """
+        return cls._bulk_write('upsert_many', cls._upsert_chunk, documents, ordered, chunk_size, max_bytes)
+
 
     @classmethod
     def update(cls, doc_id, document, specs=None, updater=raw_updater, *args, **kwargs):
@@ -161,9 +723,17 @@ class Resource(object):
         :param args: Extra positional parameters for the call to :method:pymongo.collections.update
         :param kwargs: Extra keyword parameters for the call to :method:pymongo.collections.update
         :rtype : int
+
+        When _write_behind is set, the updates made with the default_updater or the inc_updater on a doc_id only are
+        buffered and None is returned, see :class:WriteBehindBuffer
         """
         document = updater(document)
-        ret = cls._make_call('update', cls._make_specs(doc_id, specs), document, *args, **kwargs)
+        bufferable = updater in (default_updater, inc_updater) and doc_id and not specs and not args and not kwargs
+        if cls._write_behind is not None and bufferable:
+            cls._write_behind.add(cls, cls._make_specs(doc_id), document)
+            return None
+        ret = cls._make_call_as('update', 'update', cls._make_specs(doc_id, specs), document, *args, **kwargs)
+        cls._invalidate(doc_id)
         if ret:
             return ret['n']
 
@@ -180,13 +750,27 @@ class Resource(object):
         """
         return cls.update(doc_id, document, specs, default_updater, *args, **kwargs)
 
+    @classmethod
+    def inc_dict(cls, doc_id, document, specs=None, *args, **kwargs):
+        """ Increment fields of an existing document using the inc_updater
+
+        :param doc_id: The document _id to modify
+        :param document: A dictionnary of increments to which $inc will be added
+        :param specs: Extra specs to select the document. Will be combined with doc_id
+        :param args: Extra positional parameters for the call to :method:pymongo.collections.update
+        :param kwargs: Extra keyword parameters for the call to :method:pymongo.collections.update
+        :rtype : int
+        """
+        return cls.update(doc_id, document, specs, inc_updater, *args, **kwargs)
+
     @classmethod
     def remove(cls, doc_id, specs=None):
         """ Remove an existing document
         :param doc_id: The id of the document to remove. This can be None and use specs only
         :param specs: Extra specs to locate the document to remove
         """
-        ret = cls._make_call('remove', cls._make_specs(doc_id, specs))
+        ret = cls._make_call_as('remove', 'remove', cls._make_specs(doc_id, specs))
+        cls._invalidate(doc_id)
         if ret:
             return ret['n']
 
@@ -197,8 +781,32 @@ class Resource(object):
         :param specs: Extra specs to locate the document
         :param args: Passed to the driver as is
         :param kwargs: Passed to the driver as is
+
+        The calls with only a doc_id are served from _cache and _negative_cache when they are set, and merged with the
+        concurrent ones when _coalesce is set, see :class:Coalescer
         """
-        return cls._make_call('find_one', cls._make_specs(doc_id, specs), *args, **kwargs)
+        if not doc_id or specs or args or kwargs:
+            return cls._make_call_as('find_one', 'find_one', cls._make_specs(doc_id, specs), *args,
+                                     **cls._find_options('find_one', args, kwargs))
+
+        if cls._get_cache() is not None:
+            document = cls._cache.get(cls._id_type(doc_id))
+            if document is not None:
+                return document
+        if cls._negative_cache is not None and cls._negative_cache.contains(cls._id_type(doc_id)):
+            return None
+        generations = None
+        if cls._cache is not None or cls._negative_cache is not None:
+            generations = cls._get_generations()
+            generation = generations.get(cls._id_type(doc_id))
+        if cls._coalesce is not None:
+            document = cls._get_coalescer().find_one(doc_id)
+        else:
+            document = cls._make_call_as('find_one', 'find_one', cls._make_specs(doc_id),
+                                         **cls._find_options('find_one', (), {}))
+        if generations is not None:
+            cls._fill(generations, cls._id_type(doc_id), document, generation)
+        return document
 
     @classmethod
     def find(cls, specs, skip=0, limit=10, *args, **kwargs):
@@ -209,7 +817,127 @@ class Resource(object):
         :param args: Passed to the driver as is
         :param kwargs: Passed to the driver as is
         """
-        return cls._make_call('find', specs, skip=skip, limit=limit, *args, **kwargs)
+        return cls._make_call_as('find', 'find', specs, skip=skip, limit=limit, *args,
+                                 **cls._find_options('find', args, kwargs))
+
+    @classmethod
+    def aggregate(cls, pipeline, batch_size=None, allow_disk_use=False, **kwargs):
+        """ Run an aggregation and stream its result with a cursor instead of a single result document.
+        When the pipeline starts with a $match the sharder can compute a shard from, the shard key is added to it so
+        the aggregation is routed to a single shard.
+        The command goes through :method:_make_call, the batches fetched afterwards are not retried.
+        :param pipeline: A list of stages
+        :param batch_size: The number of documents per batch, None lets the server decide
+        :param allow_disk_use: Let the stages write temporary files when they exceed the memory limit
+        :param kwargs: Passed to the driver as is
+        :return: A CommandCursor
+        """
+        kwargs = dict(kwargs)
+        if allow_disk_use:
+            kwargs['allowDiskUse'] = True
+        if pymongo.version_tuple[0] >= 3:
+            if batch_size:
+                kwargs['batchSize'] = batch_size
+        else:
+            # pymongo 2.x returns the result in a single document unless a cursor is asked for
+            kwargs.setdefault('cursor', {'batchSize': batch_size} if batch_size else {})
+        return cls._make_call_as('aggregate', 'aggregate', cls._shard_pipeline(pipeline), **kwargs)
+
+    @classmethod
+    def _shard_pipeline(cls, pipeline):
+        """
+        Add the shard key to the leading $match of a pipeline, the pipeline given is not modified
+        """
+        if not cls._shard or not pipeline or '$match' not in pipeline[0] or cls._shard[1] in pipeline[0]['$match']:
+            return pipeline
+        match = cls._add_shard(dict(pipeline[0]['$match']))
+        if cls._shard[1] not in match:
+            return pipeline
+        return [{'$match': match}] + list(pipeline[1:])
+
+    @classmethod
+    def iter_all(cls, specs=None, batch_size=1000, sort_key='_id', start_after=None, **kwargs):
+        """ Iterate over all the matching documents, paging on a range of sort_key instead of skip.
+        Each page is an index seek and is fetched through :method:_make_call, so a failure only retries the current
+        page. Only one page is held in memory.
+        :param specs: Extra specs to locate the documents
+        :param batch_size: Number of documents fetched per page
+        :param sort_key: A unique, indexed field to page on
+        :param start_after: Resume after this sort_key value, typically the last one processed before a crash
+        :param kwargs: Passed to the driver as is
+        """
+        specs = specs or {}
+        kwargs = cls._find_options('iter_all', (), kwargs, sort_key)
+        last = start_after
+        while True:
+            page_specs = specs
+            if last is not None:
+                if sort_key in specs:
+                    page_specs = {'$and': [specs, {sort_key: {'$gt': last}}]}
+                else:
+                    page_specs = dict(specs)
+                    page_specs[sort_key] = {'$gt': last}
+            page = cls._make_call_as('iter_all', cls._fetch_page, page_specs, sort_key, batch_size, **kwargs)
+            for document in page:
+                yield document
+            if len(page) < batch_size:
+                return
+            last = page[-1][sort_key]
+
+    @staticmethod
+    def _fetch_page(collection, specs, sort_key, batch_size, **kwargs):
+        return list(collection.find(specs, sort=[(sort_key, 1)], limit=batch_size, **kwargs))
+
+    @classmethod
+    def _segment_specs(cls, specs, segments):
+        """
+        Split the _id range matching specs in segments of equal duration, using the ObjectId timestamps.
+        The first and last segments are open ended so documents inserted during the scan are not missed.
+        :return: A list of specs, one per segment
+        """
+        if segments < 1:
+            raise ValueError("segments must be at least 1, got %r" % segments)
+        kwargs = cls._find_options('parallel_scan', (), {PROJECTION: {'_id': 1}})
+        first = cls._make_call_as('parallel_scan', 'find_one', specs, sort=[('_id', 1)], **kwargs)
+        if first is None:
+            return []
+        if segments == 1:
+            return [specs]
+        last = cls._make_call_as('parallel_scan', 'find_one', specs, sort=[('_id', -1)], **kwargs)
+        start = first['_id'].generation_time
+        step = (last['_id'].generation_time - start) / segments
+        if not step:
+            return [specs]
+
+        bounds = [ObjectId.from_datetime(start + step * i) for i in xrange(1, segments)]
+        ranges = [{'$lt': bounds[0]}]
+        ranges.extend({'$gte': lower, '$lt': upper} for lower, upper in zip(bounds[:-1], bounds[1:]))
+        ranges.append({'$gte': bounds[-1]})
+
+        segments_specs = []
+        for id_range in ranges:
+            if '_id' in specs:
+                segments_specs.append({'$and': [specs, {'_id': id_range}]})
+            else:
+                segment_specs = dict(specs)
+                segment_specs['_id'] = id_range
+                segments_specs.append(segment_specs)
+        return segments_specs
+
+    @classmethod
+    def parallel_scan(cls, specs=None, segments=4, workers=4, ordered=False, batch_size=1000, **kwargs):
+        """ Scan all the matching documents on several threads.
+        The _id range is split in segments of equal duration, which requires ObjectId _ids. Each segment is read
+        with :method:iter_all on its own thread and the documents are merged in one stream.
+        :param specs: Extra specs to locate the documents
+        :param segments: The number of _id ranges
+        :param workers: The number of threads, and of connections used
+        :param ordered: Yield the segments one after the other so the documents come sorted by _id
+        :param batch_size: The page size of each segment
+        :param kwargs: Passed to the driver as is
+        """
+        specs = specs or {}
+        return scan(cls, cls._segment_specs(specs, segments), workers, ordered, batch_size, **kwargs)
 
     @classmethod
     def find_in(cls, doc_ids, *args, **kwargs):
@@ -217,24 +945,214 @@ class Resource(object):
         :param doc_ids: A list of ids to find
         :param args: Passed to the driver as is
         :param kwargs: Passed to the driver as is
+
+        When _shard is set the query also has the shard values of the ids, so mongos only sends it to the shards owning
+        them. When _cache is set and no driver parameter is given, the result is a list of the cached and fetched documents.
+        """
+        return cls._find_in_ids([cls._id_type(_id) for _id in doc_ids], 'find_in', *args, **kwargs)
+
+    @classmethod
+    def _find_in_ids(cls, ids, operation, *args, **kwargs):
+        """
+        find_in for already coerced ids
+        :param operation: The Resource operation the calls are recorded as
+        """
+        if cls._get_cache() is not None and not args and not kwargs:
+            return cls._find_in_cached(ids, operation)
+        return cls._find_in(ids, operation, *args, **kwargs)
+
+    @classmethod
+    def _find_in_cached(cls, ids, operation):
+        documents = []
+        missing = []
+        for _id in ids:
+            document = cls._cache.get(_id)
+            if document is None:
+                missing.append(_id)
+            else:
+                documents.append(document)
+        if missing:
+            generations = cls._get_generations()
+            missing_generations = dict((_id, generations.get(_id)) for _id in missing)
+            for document in cls._find_in(missing, operation):
+                _id = document['_id']
+                if _id in missing_generations:
+                    cls._fill(generations, _id, document, missing_generations[_id])
+                documents.append(document)
+        return documents
+
+    @classmethod
+    def _find_in(cls, ids, operation, *args, **kwargs):
+        """
+        The $in query of find_in, without the cache
+        :param operation: The Resource operation the call is recorded as, and whose read preference is used
+        """
+        kwargs = cls._find_options(operation, args, kwargs)
+        specs = cls._shard_spec(ids) if cls._shard else {'_id': {'$in': ids}}
+        return cls._make_call_as(operation, 'find', specs, *args, **kwargs)
+
+    @classmethod
+    def _shard_values(cls, ids):
+        """
+        :param ids: A list of coerced ids
+        :return: The list of their shard values, None for the ids the sharder can't shard
+        """
+        many = getattr(cls._shard[0], 'many', None)  # A batch version of the sharder, see object_id_shard_many
+        if many is not None:
+            try:
+                return many(ids)
+            except Exception:
+                pass  # _add_shard logs the ids it can't shard
+        return [cls._add_shard({'_id': _id}).get(cls._shard[1]) for _id in ids]
+
+    @classmethod
+    def _shard_spec(cls, ids):
+        """
+        The specs of a lookup by ids, with the shard values of the ids so mongos only queries the shards owning them.
+        Without the shard key when an id can't be sharded, the query then goes to all the shards.
+        :param ids: A list of coerced ids
+        :return: {'_id': {'$in': [...]}, shard_key: value or {'$in': [...]}}
+        """
+        spec = {'_id': {'$in': ids}}
+        shards = []
+        seen = set()
+        for shard in cls._shard_values(ids):
+            if shard is None:
+                return spec
+            if shard not in seen:
+                seen.add(shard)
+                shards.append(shard)
+        if shards:
+            spec[cls._shard[1]] = shards[0] if len(shards) == 1 else {'$in': shards}
+        return spec
+
+    @classmethod
+    def exists(cls, doc_id):
+        """ Check if a document exists without fetching it
+        :param doc_id: The id of the document
+        :rtype: bool
+        """
+        return cls._id_type(doc_id) in cls.existing_ids([doc_id])
+
+    @classmethod
+    def existing_ids(cls, doc_ids, chunk_size=RESOLVE_CHUNK_SIZE):
+        """ Find which ids of a list have a document, without fetching the documents.
+        Only the _id is projected and the shard values of the ids are added to the query, see :method:_shard_spec, so
+        each chunk is one query answered from the index by the shards owning the ids. The ids in _cache are known to
+        exist and the ones in _negative_cache known to be missing, they are not queried.
+        :param doc_ids: An iterable of ids
+        :param chunk_size: The number of ids per query
+        :return: The set of the coerced ids having a document
+        """
+        existing = set()
+        doc_ids = iter(doc_ids)
+        while True:
+            chunk = [cls._id_type(_id) for _id in itertools.islice(doc_ids, chunk_size)]
+            if not chunk:
+                return existing
+            ids = []
+            cache = cls._get_cache()
+            for _id in chunk:
+                if cache is not None and cache.get(_id) is not None:
+                    existing.add(_id)
+                elif cls._negative_cache is None or not cls._negative_cache.contains(_id):
+                    ids.append(_id)
+            if not ids:
+                continue
+            specs = cls._shard_spec(ids) if cls._shard else {'_id': {'$in': ids}}
+            kwargs = cls._find_options('find_in', (), {PROJECTION: {'_id': 1}})
+            if cls._negative_cache is not None:
+                generations = cls._get_generations()
+                ids_generations = [generations.get(_id) for _id in ids]
+            found = set(cls._make_call_as('existing_ids', cls._fetch_ids, specs, **kwargs))
+            if cls._negative_cache is not None:
+                for _id, generation in zip(ids, ids_generations):
+                    if _id not in found:
+                        cls._fill(generations, _id, None, generation)
+            existing.update(found)
+
+    @staticmethod
+    def _fetch_ids(collection, specs, **kwargs):
+        return [document['_id'] for document in collection.find(specs, **kwargs)]
+
+    @classmethod
+    def _resolve_chunks(cls, doc_ids, chunk_size, operation, *args, **kwargs):
         """
-        specs = {'_id': {'$in': [cls._id_type(_id) for _id in doc_ids]}}
-        return cls._make_call('find', specs, *args, **kwargs)
+        Coerce and fetch the ids chunk by chunk. The ids of _negative_cache are not fetched, the ones not found are
+        added to it.
+        :return: A generator of (coerced ids of the chunk, {_id: document found})
+        """
+        negative_cache = cls._negative_cache
+        doc_ids = iter(doc_ids)
+        while True:
+            chunk = [cls._id_type(_id) for _id in itertools.islice(doc_ids, chunk_size)]
+            if not chunk:
+                return
+            ids = chunk
+            if negative_cache is not None:
+                ids = [_id for _id in chunk if not negative_cache.contains(_id)]
+            found = {}
+            if negative_cache is not None and ids:
+                generations = cls._get_generations()
+                ids_generations = [generations.get(_id) for _id in ids]
+            if ids:
+                documents = cls._find_in_ids(ids, operation, *args, **kwargs)
+                found = dict((document['_id'], document) for document in documents)
+            if negative_cache is not None and len(found) < len(ids):
+                for _id, generation in zip(ids, ids_generations):
+                    if _id not in found:
+                        cls._fill(generations, _id, None, generation)
+            yield chunk, found
+
+    @classmethod
+    def iter_resolve(cls, doc_ids, *args, **kwargs):
+        """ Stream the documents of a list of ids, in the order of the ids.
+        The ids are fetched chunk_size at a time so only one chunk of documents is held in memory.
+        Raise an exception as soon as a chunk has a missing id.
+        :param doc_ids: An iterable of ids to find
+        :param args: Passed to the driver as is
+        :param kwargs: Passed to the driver as is, except:
+            chunk_size: the number of ids per query, default RESOLVE_CHUNK_SIZE
+        :raise MissingIdsException: With the missing coerced ids of the chunk
+        """
+        chunk_size = kwargs.pop('chunk_size', RESOLVE_CHUNK_SIZE)
+        for chunk, found in cls._resolve_chunks(doc_ids, chunk_size, 'iter_resolve', *args, **kwargs):
+            if len(found) < len(set(chunk)):
+                raise MissingIdsException(set(_id for _id in chunk if _id not in found))
+            for _id in chunk:
+                yield found[_id]
 
     @classmethod
     def resolve(cls, doc_ids, *args, **kwargs):
         """ Find documents in a list of ids. Raise an exception if an id is missing
         :param doc_ids: A list of ids to find
         :param args: Passed to the driver as is
-        :param kwargs: Passed to the driver as is
+        :param kwargs: Passed to the driver as is, except:
+            as_dict: return a dict {_id: document} instead of a list
+            chunk_size: the number of ids per query, default RESOLVE_CHUNK_SIZE
+            check_missing: check the ids with :method:existing_ids first, so missing ids are reported without
+                fetching any document. Costs an extra query per chunk when they all exist.
+        :return: The documents in the order of doc_ids
+        :raise MissingIdsException: With all the missing ids, coerced to _id_type
         """
-        from_mongo = []
-        if doc_ids:
-            doc = cls.find_in(doc_ids, *args, **kwargs)
-            from_mongo = list(doc)
-            if len(from_mongo) != len(doc_ids):
-                ids_from_mongo = [mongo['_id'] for mongo in from_mongo]
-                missing_ids = set(doc_ids) - set(ids_from_mongo)
-                if missing_ids:
-                    raise MissingIdsException(missing_ids)
-        return from_mongo
+        as_dict = kwargs.pop('as_dict', False)
+        chunk_size = kwargs.pop('chunk_size', RESOLVE_CHUNK_SIZE)
+        if kwargs.pop('check_missing', False):
+            doc_ids = [cls._id_type(_id) for _id in doc_ids or []]
+            missing_ids = set(doc_ids) - cls.existing_ids(doc_ids, chunk_size)
+            if missing_ids:
+                raise MissingIdsException(missing_ids)
+        documents = {} if as_dict else []
+        missing_ids = set()
+        for chunk, found in cls._resolve_chunks(doc_ids or [], chunk_size, 'resolve', *args, **kwargs):
+            for _id in chunk:
+                document = found.get(_id)
+                if document is None:
+                    missing_ids.add(_id)
+                elif as_dict:
+                    documents[_id] = document
+                else:
+                    documents.append(document)
+        if missing_ids:
+            raise MissingIdsException(missing_ids)
+        return documents
@@ -0,0 +1,126 @@
+# coding=utf-8
+
+"""
+Retry policies for :method:Resource._make_call
+"""
+
+import random
+import threading
+import time
+
+from pymongo.errors import AutoReconnect
+
+
+class RetryBudget(object):
+    """
+    A token bucket capping the retries to a ratio of the calls.
+    Every call deposits ratio token, every retry withdraws one. The bucket starts full so a cold process can retry.
+    """
+
+    def __init__(self, ratio=0.1, max_tokens=10):
+        """
+        :param ratio: Retries allowed per call
+        :param max_tokens: Size of the bucket, the retries allowed in a burst
+        """
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = float(max_tokens)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        """
+        :return: True if a retry is allowed
+        """
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+_budgets = {}
+_budgets_lock = threading.Lock()
+
+
+def get_budget(alias, ratio=0.1, max_tokens=10):
+    """
+    The budget shared by all the Resources of a connection alias. The first call for an alias sets its parameters.
+    """
+    with _budgets_lock:
+        if alias not in _budgets:
+            _budgets[alias] = RetryBudget(ratio, max_tokens)
+        return _budgets[alias]
+
+
+class RetryPolicy(object):
+    """
+    When and how long to wait before retrying a call.
+
+    Use it in a Resource:
+
+        >>> class UserResource(Resource):
+        >>>     _retry_policy = RetryPolicy(retries=3, delay=0.05, jitter=True, budget_ratio=0.1, deadline=0.5)
+
+    Without _retry_policy a Resource uses its _retries and _delay with a deterministic backoff and no budget.
+    """
+
+    def __init__(self, retries=0, delay=0.01, max_delay=None, jitter=False, budget_ratio=None, budget_tokens=10,
+                 deadline=None, retryable=(AutoReconnect,)):
+        """
+        :param retries: Maximum number of retries
+        :param delay: Exponential backoff base, in seconds
+        :param max_delay: Cap of a single backoff, in seconds
+        :param jitter: Sleep a random time between 0 and the backoff ("full jitter") so clients don't retry in lock-step
+        :param budget_ratio: Cap the retries to this ratio of the calls, shared by all the Resources of an alias.
+            None disables the budget
+        :param budget_tokens: The retries allowed in a burst by the budget
+        :param deadline: Time allowed for a call and its retries, in seconds. No retry is made if it would end after it
+        :param retryable: The exceptions triggering a retry
+        """
+        self.retries = retries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.budget_ratio = budget_ratio
+        self.budget_tokens = budget_tokens
+        self.deadline = deadline
+        self.retryable = retryable
+
+    def budget(self, alias):
+        if self.budget_ratio is None:
+            return None
+        return get_budget(alias, self.budget_ratio, self.budget_tokens)
+
+    def remaining(self, started):
+        """
+        :return: The seconds left before the deadline, None without deadline
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline - (time.time() - started)
+
+    def backoff(self, n, started, budget=None):
+        """
+        How long to sleep before the retry n (starting at 0)
+        :param n: The number of retries already made
+        :param started: When the call started
+        :param budget: The RetryBudget to withdraw from
+        :return: The delay in seconds, None if the call should not be retried
+        """
+        if n >= self.retries:
+            return None
+        delay = self.delay * (2 ** n)
+        if self.max_delay is not None:
+            delay = min(delay, self.max_delay)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        remaining = self.remaining(started)
+        if remaining is not None and remaining <= delay:
+            return None
+        if budget is not None and not budget.withdraw():
+            return None
+        return delay
@@ -0,0 +1,211 @@
+# coding=utf-8
+
+"""
+A Resource spread over several clusters, one connection alias each
+"""
+
+import itertools
+from multiprocessing.pool import ThreadPool
+
+from bson import ObjectId
+
+from mongothin import raw_updater
+from mongothin.resource import RESOLVE_CHUNK_SIZE, Resource
+
+
+class RoutedResource(Resource):
+    """
+    A RoutedResource stores each document on one of several aliases, picked by a router function:
+
+        >>> class UserResource(RoutedResource):
+        >>>     # All the aliases the documents are spread over
+        >>>     _aliases = ('user1', 'user2')
+        >>>     # Takes specs, or a document, and returns its alias. None when it can't tell, the call then goes to all
+        >>>     # the aliases. A router.many(ids) batch version is used when present
+        >>>     _router = object_id_router(_aliases)
+        >>>     # Threads used to query the aliases in parallel, defaults to one per alias
+        >>>     _router_workers = None
+
+    insert, update, remove and find_one go to the alias of the document. find, find_in (hence resolve) and
+    existing_ids query the aliases in parallel and merge the results. insert_many and upsert_many group the documents
+    by alias, ordered then applies per alias. iter_all, parallel_scan and aggregate need an alias:
+    UserResource.for_alias('user1'), they raise a ValueError otherwise.
+    """
+
+    _aliases = ()
+    _router = None
+    _router_workers = None
+
+    @classmethod
+    def for_alias(cls, alias):
+        """
+        :return: This Resource bound to a single alias, a subclass sharing the configuration of this one
+        """
+        targets = cls._get_lazy('_targets', dict)
+        target = targets.get(alias)
+        if target is None:
+            dct = {'_alias': alias, '_aliases': (), '_collection': cls._collection, '__module__': cls.__module__}
+            target = targets.setdefault(alias, type(cls)(cls.__name__, (cls,), dct))
+        return target
+
+    @classmethod
+    def _get_router(cls):
+        # A function set as class attribute comes back as an unbound method
+        return getattr(cls._router, '__func__', cls._router)
+
+    @classmethod
+    def _route(cls, specs):
+        return cls._get_router()(specs)
+
+    @classmethod
+    def _scatter(cls, function, aliases=None):
+        """
+        Call function(target) for each alias target in parallel
+        :return: The list of the results, in the order of the aliases
+        """
+        aliases = aliases or cls._aliases
+        pool = cls._get_lazy('_router_pool', lambda: ThreadPool(cls._router_workers or len(cls._aliases)))
+        return pool.map(lambda alias: function(cls.for_alias(alias)), aliases)
+
+    @classmethod
+    def _check_alias(cls, method):
+        if cls._aliases:
+            raise ValueError("%s.%s needs an alias, use %s.for_alias(alias).%s" % (
+                cls.__name__, method, cls.__name__, method))
+
+    @classmethod
+    def iter_all(cls, *args, **kwargs):
+        cls._check_alias('iter_all')
+        return super(RoutedResource, cls).iter_all(*args, **kwargs)
+
+    @classmethod
+    def parallel_scan(cls, *args, **kwargs):
+        cls._check_alias('parallel_scan')
+        return super(RoutedResource, cls).parallel_scan(*args, **kwargs)
+
+    @classmethod
+    def aggregate(cls, *args, **kwargs):
+        cls._check_alias('aggregate')
+        return super(RoutedResource, cls).aggregate(*args, **kwargs)
+
+    @classmethod
+    def insert(cls, document, doc_id=None):
+        if not cls._aliases:
+            return super(RoutedResource, cls).insert(document, doc_id)
+        if not doc_id:
+            doc_id = ObjectId
+        if callable(doc_id):
+            doc_id = doc_id()
+        document['_id'] = doc_id
+        alias = cls._route(document)
+        if alias is None:
+            raise ValueError("Can't route document %s" % doc_id)
+        return cls.for_alias(alias).insert(document, doc_id)
+
+    @classmethod
+    def _bulk_write(cls, operation, function, documents, ordered, chunk_size, max_bytes):
+        if not cls._aliases:
+            return super(RoutedResource, cls)._bulk_write(operation, function, documents, ordered, chunk_size,
+                                                          max_bytes)
+        by_alias = {}
+        for document in cls._prepare_bulk(documents):
+            alias = cls._route(document)
+            if alias is None:
+                raise ValueError("Can't route document %s" % document['_id'])
+            by_alias.setdefault(alias, []).append(document)
+        ids = []
+        errors = []
+        for alias, alias_documents in by_alias.iteritems():
+            alias_ids, alias_errors = cls.for_alias(alias)._bulk_write(operation, function, alias_documents, ordered,
+                                                                       chunk_size, max_bytes)
+            ids.extend(alias_ids)
+            errors.extend(alias_errors)
+        return ids, errors
+
+    @classmethod
+    def update(cls, doc_id, document, specs=None, updater=raw_updater, *args, **kwargs):
+        if not cls._aliases:
+            return super(RoutedResource, cls).update(doc_id, document, specs, updater, *args, **kwargs)
+        alias = cls._route(cls._make_specs(doc_id, specs))
+        update = lambda target: target.update(doc_id, document, specs, updater, *args, **kwargs)
+        if alias is not None:
+            return update(cls.for_alias(alias))
+        return sum(n or 0 for n in cls._scatter(update))
+
+    @classmethod
+    def remove(cls, doc_id, specs=None):
+        if not cls._aliases:
+            return super(RoutedResource, cls).remove(doc_id, specs)
+        alias = cls._route(cls._make_specs(doc_id, specs))
+        if alias is not None:
+            return cls.for_alias(alias).remove(doc_id, specs)
+        return sum(n or 0 for n in cls._scatter(lambda target: target.remove(doc_id, specs)))
+
+    @classmethod
+    def find_one(cls, doc_id, specs=None, *args, **kwargs):
+        if not cls._aliases:
+            return super(RoutedResource, cls).find_one(doc_id, specs, *args, **kwargs)
+        alias = cls._route(cls._make_specs(doc_id, specs))
+        find_one = lambda target: target.find_one(doc_id, specs, *args, **kwargs)
+        if alias is not None:
+            return find_one(cls.for_alias(alias))
+        for document in cls._scatter(find_one):
+            if document is not None:
+                return document
+        return None
+
+    @classmethod
+    def find(cls, specs, skip=0, limit=10, *args, **kwargs):
+        """ Find several documents on all the aliases.
+        Each alias returns up to skip + limit documents, then skip and limit are applied to the merged documents,
+        after sorting them when a sort is given. Returns a list instead of a cursor.
+        """
+        if not cls._aliases:
+            return super(RoutedResource, cls).find(specs, skip, limit, *args, **kwargs)
+        alias_limit = skip + limit if limit else 0
+        results = cls._scatter(lambda target: list(target.find(specs, 0, alias_limit, *args, **kwargs)))
+        documents = list(itertools.chain.from_iterable(results))
+        for field, direction in reversed(kwargs.get('sort') or []):
+            documents.sort(key=lambda document: document.get(field), reverse=direction < 0)
+        return documents[skip:skip + limit] if limit else documents[skip:]
+
+    @classmethod
+    def _group_ids(cls, ids):
+        """
+        Group coerced ids by alias, the ids that can't be routed go to all the aliases
+        :return: {alias: [ids]}
+        """
+        many = getattr(cls._get_router(), 'many', None)
+        if many is not None:
+            aliases = many(ids)
+        else:
+            aliases = [cls._route({'_id': _id}) for _id in ids]
+
+        by_alias = {}
+        for _id, alias in zip(ids, aliases):
+            for target_alias in ([alias] if alias is not None else cls._aliases):
+                by_alias.setdefault(target_alias, []).append(_id)
+        return by_alias
+
+    @classmethod
+    def existing_ids(cls, doc_ids, chunk_size=RESOLVE_CHUNK_SIZE):
+        if not cls._aliases:
+            return super(RoutedResource, cls).existing_ids(doc_ids, chunk_size)
+        by_alias = cls._group_ids([cls._id_type(_id) for _id in doc_ids])
+        if not by_alias:
+            return set()
+        targets = by_alias.keys()
+        results = cls._scatter(lambda target: target.existing_ids(by_alias[target._alias], chunk_size), targets)
+        return set().union(*results)
+
+    @classmethod
+    def _find_in_ids(cls, ids, operation, *args, **kwargs):
+        if not cls._aliases:
+            return super(RoutedResource, cls)._find_in_ids(ids, operation, *args, **kwargs)
+        by_alias = cls._group_ids(ids)
+        if not by_alias:
+            return iter([])
+        targets = by_alias.keys()
+        results = cls._scatter(
+            lambda target: list(target._find_in_ids(by_alias[target._alias], operation, *args, **kwargs)), targets)
+        return itertools.chain.from_iterable(results)
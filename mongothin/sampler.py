@@ -0,0 +1,162 @@
+# coding=utf-8
+
+"""
+Log and aggregate the slow Resource calls by the shape of their specs
+"""
+
+import logging
+from multiprocessing.pool import ThreadPool
+import random
+import threading
+
+
+def spec_shape(specs):
+    """
+    Replace the values of a spec by their type name so the same query with different values has the same shape:
+    {'_id': ObjectId('...'), 'shard': 'AB'} gives {'_id': 'ObjectId', 'shard': 'str'}. Operators are kept.
+    :param specs: A query spec
+    """
+    if isinstance(specs, dict):
+        return dict((key, spec_shape(value)) for key, value in specs.iteritems())
+    if isinstance(specs, (list, tuple)):
+        shapes = []
+        for value in specs:
+            shape = spec_shape(value)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return type(specs).__name__
+
+
+def shape_key(shape):
+    """
+    A stable string for a shape, to group on
+    """
+    if isinstance(shape, dict):
+        return '{%s}' % ', '.join('%s: %s' % (key, shape_key(shape[key])) for key in sorted(shape))
+    if isinstance(shape, list):
+        return '[%s]' % ', '.join(sorted(shape_key(value) for value in shape))
+    return shape
+
+
+def explain_summary(explain):
+    """
+    Extract from an explain output if an index was used and how many shards were queried.
+    Handles the legacy (mongod < 3.0) and the queryPlanner formats, mongos 3.0+ lists the shards queried in the
+    winning plan.
+    :return: {'indexed': bool, 'shards': int}
+    """
+    shards = explain.get('shards')
+    planner_shards = explain.get('queryPlanner', {}).get('winningPlan', {}).get('shards')
+    if isinstance(shards, dict):
+        plans = shards.values()
+        shard_count = len(shards)
+    elif isinstance(planner_shards, list):  # SHARD_MERGE or SINGLE_SHARD stage, a winningPlan per shard
+        plans = planner_shards
+        shard_count = len(planner_shards)
+    else:
+        plans = [explain]
+        shard_count = 1
+    indexed = True
+    for plan in plans:
+        if isinstance(plan, list):  # Legacy sharded explain: a list per shard
+            plan = plan[0] if plan else {}
+        if 'cursor' in plan:
+            indexed = indexed and not plan['cursor'].startswith('BasicCursor')
+        else:
+            winning = repr(plan.get('queryPlanner', plan).get('winningPlan', {}))
+            indexed = indexed and 'COLLSCAN' not in winning
+    return {'indexed': indexed, 'shards': shard_count}
+
+
+class SlowQuerySampler(object):
+    """
+    Samples the Resource calls slower than a threshold.
+
+    Each sample is logged and aggregated by (collection, operation, shape). For a ratio of the samples the query is
+    explained in the background to tell if it used an index and how many shards it hit.
+
+        >>> class UserResource(Resource):
+        >>>     _sampler = SlowQuerySampler(threshold=0.1, explain_rate=0.01)
+
+    """
+
+    # The operations whose spec is a find query
+    explained_operations = ('find', 'find_one', 'find_in', 'resolve', 'iter_resolve', 'iter_all', 'existing_ids')
+
+    def __init__(self, threshold=0.1, explain_rate=0.0, logger=None):
+        """
+        :param threshold: The duration above which a call is sampled, in seconds
+        :param explain_rate: The ratio of the samples explained
+        :param logger: Where the samples are logged, defaults to mongothin.slow
+        """
+        self.threshold = threshold
+        self.explain_rate = explain_rate
+        self.log = logger or logging.getLogger('mongothin.slow')
+        self._shapes = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(1)
+            return self._pool
+
+    def sample(self, resource, operation, args, duration, retries):
+        """
+        Called after every call, keeps it if slower than the threshold
+        :param resource: The Resource class
+        :param operation: The collection method called
+        :param args: The positional arguments of the call, the first one is the spec
+        :param duration: In seconds
+        :param retries: The number of retries made
+        """
+        if duration < self.threshold:
+            return
+        specs = args[0] if args and isinstance(args[0], dict) else {}
+        key = (resource._collection, operation, shape_key(spec_shape(specs)))
+        with self._lock:
+            entry = self._shapes.get(key)
+            if entry is None:
+                entry = self._shapes[key] = {'count': 0, 'total': 0.0, 'max': 0.0, 'retries': 0,
+                                             'indexed': None, 'shards': None}
+            entry['count'] += 1
+            entry['total'] += duration
+            entry['max'] = max(entry['max'], duration)
+            entry['retries'] += retries
+        self.log.warning("Slow %s on %s.%s (alias %s): %.1fms, %d retries, shape %s" % (
+            operation, resource.__name__, resource._collection, resource._alias, duration * 1000, retries, key[2]))
+        if operation in self.explained_operations and random.random() < self.explain_rate:
+            self._get_pool().apply_async(self._explain, (resource, key, specs))
+
+    def _explain(self, resource, key, specs):
+        try:
+            explain = lambda collection: collection.find(specs).explain()
+            summary = explain_summary(resource._make_call_as('explain', explain))
+        except Exception as exc:
+            self.log.warning("Can't explain %s: %s" % (key[2], exc))
+            return
+        with self._lock:
+            entry = self._shapes.get(key)
+            if entry is None:  # reset() ran meanwhile
+                return
+            entry.update(summary)
+        self.log.warning("Explained %s on %s: indexed %s, %d shard(s)" % (
+            key[1], key[0], summary['indexed'], summary['shards']))
+
+    def report(self):
+        """
+        :return: A list of {'collection', 'operation', 'shape', 'count', 'total', 'max', 'retries', 'indexed',
+            'shards'} sorted by total time spent, slowest first. indexed and shards are None until explained.
+        """
+        with self._lock:
+            report = []
+            for (collection, operation, shape), entry in self._shapes.iteritems():
+                row = dict(entry, collection=collection, operation=operation, shape=shape)
+                report.append(row)
+        return sorted(report, key=lambda row: row['total'], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._shapes.clear()
@@ -0,0 +1,91 @@
+# coding=utf-8
+
+"""
+Scan a collection on several threads, each one reading a contiguous range of _id
+"""
+
+from multiprocessing.pool import ThreadPool
+from Queue import Full, Queue
+import threading
+
+
+class _EndOfSegment(object):
+    """
+    Put on the queue by a worker when its segment is exhausted, or failed
+    """
+
+    def __init__(self, error=None):
+        self.error = error
+
+
+def _put(queue, item, stop):
+    """
+    Put on a bounded queue, giving up when the consumer went away
+    :return: False if the scan was stopped
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _scan_segment(resource, specs, queue, stop, batch_size, kwargs):
+    error = None
+    try:
+        for document in resource.iter_all(specs, batch_size=batch_size, **kwargs):
+            if not _put(queue, document, stop):
+                return
+    except Exception as exc:
+        error = exc
+    _put(queue, _EndOfSegment(error), stop)
+
+
+def _drain(queue, segments):
+    """
+    Yield the documents of a queue until segments segments have ended
+    """
+    while segments:
+        item = queue.get()
+        if isinstance(item, _EndOfSegment):
+            if item.error is not None:
+                raise item.error
+            segments -= 1
+        else:
+            yield item
+
+
+def scan(resource, segments_specs, workers, ordered=False, batch_size=1000, queue_size=10000, **kwargs):
+    """
+    Scan each segment with :method:Resource.iter_all on a pool of threads and merge the documents in one stream.
+    :param resource: The Resource class to scan
+    :param segments_specs: A list of specs, one per segment
+    :param workers: The number of threads
+    :param ordered: Yield the segments one after the other, in order. Otherwise documents are yielded as they come.
+    :param batch_size: The page size of each segment
+    :param queue_size: The number of documents buffered, per segment when ordered
+    :param kwargs: Passed to the driver as is
+    """
+    if not segments_specs:
+        return
+    stop = threading.Event()
+    pool = ThreadPool(workers)
+    try:
+        if ordered:
+            queues = [Queue(queue_size) for _ in segments_specs]
+        else:
+            queues = [Queue(queue_size)] * len(segments_specs)
+        for specs, queue in zip(segments_specs, queues):
+            pool.apply_async(_scan_segment, (resource, specs, queue, stop, batch_size, kwargs))
+        if ordered:
+            for queue in queues:
+                for document in _drain(queue, 1):
+                    yield document
+        else:
+            for document in _drain(queues[0], len(segments_specs)):
+                yield document
+    finally:
+        stop.set()
+        pool.close()
@@ -0,0 +1,179 @@
+# coding=utf-8
+
+"""
+Buffer the $set and $inc updates of hot documents and write them in bulk
+"""
+
+import atexit
+import os
+import threading
+import time
+
+
+_fork_lock = threading.Lock()
+
+
+def _numeric(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def merge_update(pending, update):
+    """
+    Merge an update document in a pending one, as if they were applied one after the other.
+    Only $set and $inc are supported: an $inc of a pending $set field changes the value set,
+    a $set of a pending $inc field replaces the increment.
+    :param pending: {'$set': {...}, '$inc': {...}}, modified in place
+    :param update: {'$set': {...}} and/or {'$inc': {...}}
+    :raise ValueError: If an increment isn't a number, or applies to a pending $set of something else than a number.
+        pending is left unchanged.
+    """
+    for field, value in update.get('$inc', {}).iteritems():
+        if not _numeric(value):
+            raise ValueError("Can't increment %s by %r" % (field, value))
+        if field in pending.get('$set', {}) and not _numeric(pending['$set'][field]):
+            raise ValueError("Can't increment %s, set to %r" % (field, pending['$set'][field]))
+    pending_set = pending.setdefault('$set', {})
+    pending_inc = pending.setdefault('$inc', {})
+    for field, value in update.get('$set', {}).iteritems():
+        pending_inc.pop(field, None)
+        pending_set[field] = value
+    for field, value in update.get('$inc', {}).iteritems():
+        if field in pending_set:
+            pending_set[field] += value
+        else:
+            pending_inc[field] = pending_inc.get(field, 0) + value
+    return pending
+
+
+class WriteBehindBuffer(object):
+    """
+    Holds the updates by document and flushes them in one bulk write per Resource when max_pending documents are
+    pending, every max_age seconds, and at exit. Updates are lost if the process dies before a flush.
+    A forked process starts with an empty buffer, the updates pending at fork time are written by the parent.
+
+    Use it in a Resource, update_dict and inc_dict then return None instead of the number of documents updated:
+
+        >>> class UserResource(Resource):
+        >>>     _write_behind = WriteBehindBuffer(max_pending=1000, max_age=1.0)
+
+    """
+
+    def __init__(self, max_pending=1000, max_age=1.0, on_flush=None, on_error=None):
+        """
+        :param max_pending: The number of pending documents triggering a flush
+        :param max_age: How long an update can stay pending, in seconds
+        :param on_flush: Called with (resource, number of documents, duration in seconds) after each bulk write
+        :param on_error: Called with (resource, exception, [(specs, update), ...]) when a bulk write fails.
+            The updates are dropped.
+        """
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self.on_flush = on_flush
+        self.on_error = on_error
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = os.getpid()
+        atexit.register(self.flush)
+
+    def _check_fork(self):
+        """
+        Drop the state inherited from the parent when running in a process forked since the last call: its pending
+        updates, its locks, that another thread may have held at fork time, and its flushing thread, which doesn't
+        run here.
+        """
+        if os.getpid() != self._pid:
+            with _fork_lock:
+                if os.getpid() != self._pid:
+                    self._pending = {}
+                    self._lock = threading.Lock()
+                    self._flush_lock = threading.Lock()
+                    self._thread = None
+                    self._pid = os.getpid()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='mongothin-write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.max_age)
+            self.flush()
+
+    def add(self, resource, specs, update):
+        """
+        Buffer an update
+        :param resource: The Resource class
+        :param specs: The spec of the document, _id and shard key, as built by :method:Resource._make_specs
+        :param update: {'$set': {...}} and/or {'$inc': {...}}
+        :raise ValueError: If the update is invalid, see :function:merge_update
+
+        An update that can't be merged in the pending one of its document, an $inc of a field set to a string for
+        instance, writes the pending one first.
+        """
+        key = (resource, specs['_id'])
+        merged = merge_update({}, update)
+        self._check_fork()
+        conflicting = None
+        with self._lock:
+            if self._thread is None:
+                self._start()
+            entry = self._pending.get(key)
+            if entry is None:
+                self._pending[key] = (specs, merged)
+            else:
+                try:
+                    merge_update(entry[1], update)
+                except ValueError:
+                    conflicting = self._pending.pop(key)
+            full = len(self._pending) >= self.max_pending
+        if conflicting is not None:
+            self._write(resource, [conflicting])
+            return self.add(resource, specs, update)
+        if full:
+            self.flush()
+
+    def pending(self):
+        """
+        :return: The number of documents with pending updates
+        """
+        self._check_fork()
+        return len(self._pending)
+
+    def flush(self):
+        """
+        Write all the pending updates, one bulk write per Resource
+        """
+        self._check_fork()
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            by_resource = {}
+            for (resource, _), (specs, update) in pending.iteritems():
+                by_resource.setdefault(resource, []).append((specs, update))
+            for resource, updates in by_resource.iteritems():
+                self._write(resource, updates)
+
+    def _write(self, resource, updates):
+        started = time.time()
+        try:
+            resource._make_call_as('write_behind', _bulk_update, updates)
+        except Exception as exc:
+            resource.log.warning("Write behind of %d documents failed: %s" % (len(updates), exc))
+            if self.on_error is not None:
+                self.on_error(resource, exc, updates)
+        else:
+            if self.on_flush is not None:
+                self.on_flush(resource, len(updates), time.time() - started)
+        finally:
+            for specs, _ in updates:
+                resource._invalidate(specs['_id'])
+
+
+def _bulk_update(collection, updates):
+    bulk = collection.initialize_unordered_bulk_op()
+    for specs, update in updates:
+        bulk.find(specs).update_one(dict((operator, fields) for operator, fields in update.iteritems() if fields))
+    return bulk.execute()
@@ -11,7 +11,8 @@ setup(
     description='Thin helper around pymongo',
     keywords=["mongo", "mongodb", "pymongo"],
     tests_require=["nose", "minimock"],
-    install_requires=["pymongo>=2.4"],
+    install_requires=["pymongo>=2.7"],
+    extras_require={"async": ["futures"]},
     packages=["mongothin"],
     test_suite="nose.collector"
 )
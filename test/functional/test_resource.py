@@ -94,3 +94,17 @@ class TestResource(unittest.TestCase):
         test_with = [str(oid) for oid in object_ids[:5]]
         test_with.append(str(ObjectId()))
         self.assertRaises(MissingIdsException, MongoResource.resolve, test_with)
+
+    def test_insert_many(self):
+        ids, errors = MongoResource.insert_many([{'test': i} for i in xrange(0, 5)], chunk_size=2)
+        self.assertEqual(errors, [])
+        documents = list(MongoResource.resolve(ids))
+        self.assertEqual([document['test'] for document in documents], range(0, 5))
+
+    def test_upsert_many(self):
+        object_id = MongoResource.insert({'test': 'test'})
+        ids, errors = MongoResource.upsert_many([{'_id': object_id, 'test': 'new'}, {'test': 'other'}])
+        self.assertEqual(errors, [])
+        self.assertEqual(ids[0], object_id)
+        self.assertDictEqual(MongoResource.find_one(object_id), {'_id': object_id, 'test': 'new'})
+        self.assertDictEqual(MongoResource.find_one(ids[1]), {'_id': ids[1], 'test': 'other'})
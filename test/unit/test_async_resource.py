@@ -0,0 +1,45 @@
+# coding=utf-8
+import unittest
+
+from bson import ObjectId
+import minimock
+
+import mongothin.connection
+from mongothin.async_resource import AsyncResource
+
+
+class MongoResource(AsyncResource):
+    _collection = 'argh'
+
+
+class TestAsyncResource(unittest.TestCase):
+    def setUp(self):
+        """Setup
+
+        """
+        super(TestAsyncResource, self).setUp()
+        mongothin.connection.register_connection('default', 'mongothin')
+
+        self.tt = minimock.TraceTracker()
+        self.mocked_collection = minimock.Mock('Collection', tracker=self.tt)
+        minimock.mock('mongothin.resource.Resource._get_db', returns={'argh': self.mocked_collection})
+
+    def tearDown(self):
+        """Teardown
+
+        """
+        super(TestAsyncResource, self).tearDown()
+        mongothin.connection._connection_settings.clear()
+        minimock.restore()
+
+    def test_find_one(self):
+        object_id = ObjectId()
+        self.mocked_collection.find_one.mock_returns = {'_id': object_id}
+        future = MongoResource.async_find_one(object_id)
+        self.assertEqual(future.result(), {'_id': object_id})
+
+    def test_find(self):
+        self.mocked_collection.find.mock_returns = iter([{'test': 1}, {'test': 2}])
+        future = MongoResource.async_find({}, limit=2)
+        self.assertEqual(future.result(), [{'test': 1}, {'test': 2}])
+        minimock.assert_same_trace(self.tt, "Called Collection.find({}, limit=2, skip=0)")
@@ -0,0 +1,98 @@
+# coding=utf-8
+import time
+import unittest
+
+from mongothin.cache import CountingBloomFilter, LRUCache, LRUNegativeCache, get_generations
+
+
+class TestLRUCache(unittest.TestCase):
+    """Test the in-process cache
+
+    """
+
+    def test_get_set(self):
+        cache = LRUCache()
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', {'_id': 'a'})
+        self.assertEqual(cache.get('a'), {'_id': 'a'})
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2, 'evictions': 0, 'size': 0})
+
+    def test_lru_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.01)
+        cache.set('a', 1)
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+
+class TestNegativeCaches(unittest.TestCase):
+    """Test the caches of missing ids
+
+    """
+
+    def test_lru_negative_cache(self):
+        cache = LRUNegativeCache(maxsize=2, ttl=None)
+        cache.add('a')
+        cache.add('b')
+        cache.add('c')
+        self.assertFalse(cache.contains('a'))
+        self.assertTrue(cache.contains('b'))
+        cache.discard('b')
+        self.assertFalse(cache.contains('b'))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 2, 1))
+        self.assertEqual(stats['false_positive_rate'], 0.0)
+
+    def test_bloom_filter(self):
+        bloom = CountingBloomFilter(capacity=1000, error_rate=0.01)
+        for i in xrange(0, 500):
+            bloom.add(i)
+        self.assertTrue(all(bloom.contains(i) for i in xrange(0, 500)))
+        false_positives = sum(bloom.contains(i) for i in xrange(500, 10500))
+        self.assertLess(false_positives, 100)
+        bloom.discard(0)
+        bloom.discard(-1)
+        self.assertFalse(bloom.contains(0))
+        self.assertTrue(bloom.contains(1))
+        stats = bloom.stats()
+        self.assertEqual(stats['size'], 499)
+        self.assertLess(stats['false_positive_rate'], 0.01)
+        self.assertEqual(stats['memory'], bloom.bits)
+
+    def test_bloom_filter_reset(self):
+        bloom = CountingBloomFilter(capacity=2, ttl=0.01)
+        bloom.add('a')
+        time.sleep(0.02)
+        self.assertFalse(bloom.contains('a'))
+        bloom.add('a')
+        bloom.add('b')
+        bloom.add('c')
+        self.assertFalse(bloom.contains('a'))
+        self.assertTrue(bloom.contains('c'))
+        self.assertEqual(bloom.stats()['resets'], 2)
+
+    def test_generations(self):
+        cache = LRUCache()
+        generations = get_generations(cache)
+        self.assertIs(get_generations(cache), generations)
+        self.assertIsNot(get_generations(LRUCache()), generations)
+        generation = generations.get('a')
+        self.assertEqual(generations.get('a'), generation)
+        generations.bump('a')
+        self.assertNotEqual(generations.get('a'), generation)
+        generation = generations.get('b')
+        generations.bump_all()
+        self.assertNotEqual(generations.get('b'), generation)
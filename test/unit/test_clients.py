@@ -1,7 +1,10 @@
 # coding=utf-8
+import os
+import time
 import unittest
 
 import minimock
+from pymongo.errors import AutoReconnect
 
 import mongothin.connection
 from test.unit import MockClient
@@ -32,6 +35,9 @@ class Testconnection(unittest.TestCase):
         mongothin.connection._connection_settings.clear()
         mongothin.connection._connections.clear()
         mongothin.connection._dbs.clear()
+        mongothin.connection._clients.clear()
+        mongothin.connection._client_keys.clear()
+        mongothin.connection._breakers.clear()
         minimock.restore()
 
     def test_register_connection(self):
@@ -118,3 +124,111 @@ class Testconnection(unittest.TestCase):
             "Called disconnect()"
         ]))
         self.assertDictEqual(mongothin.connection._dbs, {})
+
+    def test_disconnect_race(self):
+        """Test a disconnect by another thread while getting the database
+
+        """
+        class Disconnecting(dict):
+            # Another thread disconnects right after a lookup
+            def __contains__(self, key):
+                found = dict.__contains__(self, key)
+                self.pop(key, None)
+                return found
+
+            def get(self, key, default=None):
+                value = dict.get(self, key, default)
+                self.pop(key, None)
+                return value
+
+        mongothin.connection.get_db('test')
+        dbs, mongothin.connection._dbs = mongothin.connection._dbs, Disconnecting(mongothin.connection._dbs)
+        connections, mongothin.connection._connections = (mongothin.connection._connections,
+                                                          Disconnecting(mongothin.connection._connections))
+        try:
+            self.assertIs(mongothin.connection.get_db('test'), self.mocked_database)
+            self.assertIs(mongothin.connection.get_connection('test'), self.mocked_client)
+        finally:
+            mongothin.connection._dbs = dbs
+            mongothin.connection._connections = connections
+
+    def test_circuit_breaker(self):
+        """Test the circuit breaker opens, fails fast and half opens
+
+        """
+        breaker = mongothin.connection.register_circuit_breaker('test', failure_ratio=0.5, min_calls=2,
+                                                                 reset_timeout=0.01)
+        self.assertIs(mongothin.connection.get_circuit_breaker('test'), breaker)
+        breaker.acquire()
+        breaker.record(AutoReconnect())
+        breaker.acquire()
+        breaker.record(ValueError())
+        self.assertEqual(breaker.state, breaker.OPEN)
+        self.assertRaises(mongothin.connection.CircuitOpenError, breaker.acquire)
+
+        time.sleep(0.01)
+        breaker.acquire()
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertRaises(mongothin.connection.CircuitOpenError, breaker.acquire)
+        breaker.record()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.acquire()
+
+    def test_fork(self):
+        """Test the clients are rebuilt after a fork
+
+        """
+        mongothin.connection.get_connection('test')
+        mongothin.connection._pid = -1
+        mongothin.connection.get_connection('test')
+        self.assertEqual(mongothin.connection._pid, os.getpid())
+        self.assertEqual(self.tt.dump().count('Called mongothin.connection.MongoClient('), 2)
+
+    def test_warmup(self):
+        """Test warming up a connection
+
+        """
+        mongothin.connection.warmup(['test'], min_connections=2)
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called mongothin.connection.MongoClient(",
+            "   host='localhost',",
+            "   port=27017,",
+            "   read_preference=False)",
+            "Called getitem('mongothin')",
+            "Called Database.command('ping')",
+            "Called Database.command('ping')",
+        ]))
+
+    def test_shared_client(self):
+        """Test aliases with the same settings share a client
+
+        """
+        mongothin.connection.register_connection('test2', 'other')
+        mongothin.connection.register_connection('test3', 'other', port=27018)
+        client = mongothin.connection.get_connection('test')
+        self.assertIs(mongothin.connection.get_connection('test2'), client)
+        mongothin.connection.get_connection('test3')
+        mongothin.connection.disconnect('test')
+        mongothin.connection.disconnect('test2')
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called mongothin.connection.MongoClient(",
+            "   host='localhost',",
+            "   port=27017,",
+            "   read_preference=False)",
+            "Called mongothin.connection.MongoClient(",
+            "   host='localhost',",
+            "   port=27018,",
+            "   read_preference=False)",
+            "Called disconnect()",
+        ]))
+
+    def test_shared_client_uri(self):
+        """Test aliases on the databases of the same replica set share a client
+
+        """
+        mongothin.connection.register_connection('test', 'db1', host='mongodb://h1,h2/db1?replicaSet=rs')
+        mongothin.connection.register_connection('test2', 'db2', host='mongodb://h2,h1/db2?replicaSet=rs')
+        minimock.mock('mongothin.connection.MongoReplicaSetClient', returns=self.mocked_client, tracker=self.tt)
+        client = mongothin.connection.get_connection('test')
+        self.assertIs(mongothin.connection.get_connection('test2'), client)
+        self.assertEqual(len(mongothin.connection._clients), 1)
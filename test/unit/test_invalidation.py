@@ -0,0 +1,121 @@
+# coding=utf-8
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from bson import BSON, ObjectId
+import minimock
+
+import mongothin.resource
+
+from mongothin.cache import LRUCache
+from mongothin.invalidation import InvalidationBus, LocalTransport, UnixSocketTransport
+from mongothin.resource import Resource
+
+
+class TestInvalidation(unittest.TestCase):
+    def setUp(self):
+        """Setup
+
+        """
+        super(TestInvalidation, self).setUp()
+        self.tt = minimock.TraceTracker()
+        self.mocked_collection = minimock.Mock('Collection', tracker=self.tt)
+        minimock.mock('mongothin.resource.Resource._get_db', returns={'argh': self.mocked_collection})
+
+    def tearDown(self):
+        """Teardown
+
+        """
+        super(TestInvalidation, self).tearDown()
+        minimock.restore()
+
+    def test_bus(self):
+        transport = LocalTransport()
+        writer_bus = InvalidationBus(transport)
+        reader_bus = InvalidationBus(transport)
+
+        class WriterResource(Resource):
+            _collection = 'argh'
+            _invalidation_bus = writer_bus
+
+        class ReaderResource(Resource):
+            _collection = 'argh'
+            _cache = LRUCache()
+
+        reader_bus.register(ReaderResource)
+        object_id = ObjectId()
+        ReaderResource._cache.set(object_id, {'_id': object_id})
+        WriterResource.update_dict(object_id, {'test': 'test'})
+        self.assertIsNone(ReaderResource._cache.get(object_id))
+        self.assertEqual(writer_bus.published, 1)
+        self.assertEqual(reader_bus.received, 1)
+        self.assertEqual(writer_bus.received, 0)
+
+    def test_unix_socket(self):
+        directory = tempfile.mkdtemp()
+        try:
+            received = []
+            done = threading.Event()
+            first = UnixSocketTransport(directory)
+            first.subscribe(lambda event: (received.append(event), done.set()))
+            second = UnixSocketTransport(directory)
+            second.subscribe(lambda event: None)
+            object_id = ObjectId()
+            second.publish({'_id': object_id})
+            done.wait(1)
+            self.assertEqual(received, [{'_id': object_id}])
+            first.close()
+            second.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_unix_socket_peers(self):
+        directory = tempfile.mkdtemp()
+        try:
+            transport = UnixSocketTransport(directory, peers_ttl=60)
+            transport.subscribe(lambda event: None)
+            peer_path = os.path.join(directory, 'peer.sock')
+            peer = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            peer.bind(peer_path)
+            transport.publish({'_id': 1})
+            # The list is kept: another socket isn't seen until it is listed again
+            minimock.mock('mongothin.invalidation.glob.glob', returns=[], tracker=self.tt)
+            transport.publish({'_id': 2})
+            self.assertEqual(self.tt.dump(), '')
+            self.assertEqual([BSON(peer.recv(65536)).decode() for _ in xrange(0, 2)], [{'_id': 1}, {'_id': 2}])
+            peer.close()
+            os.unlink(peer_path)
+            transport.publish({'_id': 3})
+            transport.publish({'_id': 4})
+            minimock.assert_same_trace(self.tt, "Called mongothin.invalidation.glob.glob('%s')"
+                                       % os.path.join(directory, '*.sock'))
+            transport.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_full_socket(self):
+        directory = tempfile.mkdtemp()
+        try:
+            # Bound but never read
+            stalled = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            stalled.bind(os.path.join(directory, 'stalled.sock'))
+            transport = UnixSocketTransport(directory)
+            for _ in xrange(0, 1000):
+                transport.publish({'_id': ObjectId()})
+            self.assertGreater(transport.dropped, 0)
+            stalled.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_fork(self):
+        transport = LocalTransport()
+        bus = InvalidationBus(transport)
+        origin = bus.origin
+        bus._pid = -1  # As if created in the parent
+        bus.check_fork()
+        self.assertNotEqual(bus.origin, origin)
+        self.assertEqual(transport.callbacks, [bus._receive])
@@ -0,0 +1,33 @@
+# coding=utf-8
+import unittest
+
+from mongothin.metrics import MetricsRegistry
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    """Test the metrics registry
+
+    """
+
+    def test_record(self):
+        registry = MetricsRegistry(buckets=(0.001, 0.01), enabled=True)
+        registry.record('UserResource', 'find_one', 0.0005)
+        registry.record('UserResource', 'find_one', 0.005, retries=1, slept=0.002, failed=True)
+        registry.record('UserResource', 'find_one', 0.5)
+        snapshot = registry.snapshot()['UserResource']['find_one']
+        self.assertEqual(snapshot['calls'], 3)
+        self.assertEqual(snapshot['errors'], 1)
+        self.assertEqual(snapshot['retries'], 1)
+        self.assertEqual(snapshot['slept'], 0.002)
+        self.assertEqual(snapshot['histogram'], [1, 1, 1])
+        self.assertEqual(snapshot['p50'], 0.01)
+        self.assertIsNone(snapshot['p99'])
+
+    def test_export(self):
+        registry = MetricsRegistry(enabled=True)
+        exported = []
+        registry.add_exporter(exported.append)
+        registry.record('UserResource', 'insert', 0.001)
+        registry.export(reset=True)
+        self.assertEqual(exported[0]['UserResource']['insert']['calls'], 1)
+        self.assertEqual(registry.snapshot()['UserResource']['insert']['calls'], 0)
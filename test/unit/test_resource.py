@@ -1,10 +1,24 @@
 # coding=utf-8
+import datetime
+import logging
+import threading
+import time
 import unittest
+import bson.tz_util
 from bson import ObjectId
 import minimock
+from pymongo import ReadPreference
+from pymongo.cursor import Cursor
+from pymongo.errors import AutoReconnect, DuplicateKeyError
 import mongothin
 import mongothin.connection
-from mongothin.resource import Resource
+import mongothin.resource
+from mongothin.cache import LRUCache, LRUNegativeCache
+from mongothin.metrics import MetricsRegistry
+from mongothin.resource import MissingIdsException, Resource
+from mongothin.retry import RetryPolicy
+from mongothin.sampler import SlowQuerySampler
+from mongothin.scan import scan
 
 
 class MongoResource(Resource):
@@ -15,6 +29,45 @@ class MongoResource(Resource):
     _shard = (mongothin.object_id_shard, 'shard',)
 
 
+class PlainResource(Resource):
+    """
+    Test resource without shard
+    """
+    _collection = 'argh'
+
+
+class Interrupted(BaseException):
+    """
+    Like gevent.Timeout
+    """
+
+
+class ScriptedCursor(Cursor):
+    """
+    A Cursor over a list of documents, or raising an exception. Each fetch takes 10ms
+    """
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def _refresh(self):
+        if isinstance(self.documents, Exception):
+            raise self.documents
+        time.sleep(0.01)
+        return len(self.documents)
+
+    def next(self):
+        if not self._refresh():
+            raise StopIteration
+        return self.documents.pop(0)
+
+    def close(self):
+        pass
+
+    def __del__(self):
+        pass
+
+
 class TestResource(unittest.TestCase):
     def setUp(self):
         """Setup
@@ -35,6 +88,9 @@ class TestResource(unittest.TestCase):
         mongothin.connection._connection_settings.clear()
         mongothin.connection._connections.clear()
         mongothin.connection._dbs.clear()
+        mongothin.connection._clients.clear()
+        mongothin.connection._client_keys.clear()
+        mongothin.connection._breakers.clear()
         minimock.restore()
 
     def test_shard_insert(self):
@@ -51,3 +107,544 @@ class TestResource(unittest.TestCase):
             "    {'_id': ObjectId('...'), 'shard': '...'})"
         ]))
 
+    def test_insert_many_chunks(self):
+        ids, errors = MongoResource.insert_many([{'test': i} for i in xrange(0, 5)], chunk_size=2)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(errors, [])
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called Collection.insert(",
+            "    [{'test': 0, '_id': ObjectId('...'), 'shard': '...'}, {'test': 1, '_id': ObjectId('...'), 'shard': '...'}],",
+            "    continue_on_error=True)",
+            "Called Collection.insert(",
+            "    [{'test': 2, '_id': ObjectId('...'), 'shard': '...'}, {'test': 3, '_id': ObjectId('...'), 'shard': '...'}],",
+            "    continue_on_error=True)",
+            "Called Collection.insert(",
+            "    [{'test': 4, '_id': ObjectId('...'), 'shard': '...'}],",
+            "    continue_on_error=True)",
+        ]))
+
+    def test_insert_many_ordered_error(self):
+        self.mocked_collection.insert.mock_raises = ValueError('boom')
+        ids, errors = MongoResource.insert_many([{'test': i} for i in xrange(0, 3)], ordered=True, chunk_size=2)
+        self.assertEqual(ids, [])
+        self.assertEqual(len(errors), 2)
+        self.assertIsInstance(errors[0]['error'], ValueError)
+        self.assertEqual(len(errors[0]['ids']), 2)
+        self.assertIsNone(errors[1]['error'])
+
+    def test_insert_many_retry(self):
+        class RetriedResource(Resource):
+            _collection = 'argh'
+            _retries = 1
+            _delay = 0
+
+        object_ids = [ObjectId() for _ in xrange(0, 4)]
+        # The failed attempt wrote the first document, the third one was already there
+        stored = [{'_id': object_ids[0], 'test': 0}, {'_id': object_ids[2], 'test': 'other'}]
+        self.mocked_collection.find.mock_returns = stored
+        failures = [AutoReconnect('down')]
+
+        def insert(chunk, continue_on_error):
+            if failures:
+                raise failures.pop(0)
+
+        self.mocked_collection.insert.mock_returns_func = insert
+        documents = [{'_id': _id, 'test': i} for i, _id in enumerate(object_ids)]
+        ids, errors = RetriedResource.insert_many(documents, ordered=True)
+        self.assertEqual(ids, [])
+        self.assertIsInstance(errors[0]['error'], DuplicateKeyError)
+        self.assertIn(str(object_ids[2]), str(errors[0]['error']))
+        # Only the document before the duplicate is inserted again, still ordered
+        self.assertTrue(self.tt.dump().endswith('\n'.join([
+            "Called Collection.insert(",
+            "    [{'test': 1, '_id': ObjectId('%s')}]," % object_ids[1],
+            "    continue_on_error=False)",
+            ""])))
+
+        self.tt.clear()
+        self.mocked_collection.find.mock_returns = stored[:1]
+        failures.append(AutoReconnect('down'))
+        ids, errors = RetriedResource.insert_many(documents, ordered=False)
+        self.assertEqual(ids, object_ids)
+        self.assertEqual(errors, [])
+        self.assertIn("Called Collection.insert(", self.tt.dump())
+        self.assertIn("continue_on_error=True", self.tt.dump().splitlines()[-1])
+
+    def test_chunk_documents_bytes(self):
+        documents = [{'data': 'x' * 100} for _ in xrange(0, 4)]
+        chunks = list(mongothin.resource.chunk_documents(documents, chunk_size=10, max_bytes=250))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2])
+
+    def test_coalesce_find_one(self):
+        object_ids = [ObjectId() for _ in xrange(0, 3)]
+        self.mocked_collection.find.mock_returns = [{'_id': object_ids[0]}, {'_id': object_ids[1]}]
+
+        class CoalescedResource(Resource):
+            _collection = 'argh'
+            _coalesce = 0.05
+
+        results = {}
+
+        def find(object_id):
+            results[object_id] = CoalescedResource.find_one(object_id)
+
+        threads = [threading.Thread(target=find, args=(object_id,)) for object_id in object_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {object_ids[0]: {'_id': object_ids[0]}, object_ids[1]: {'_id': object_ids[1]},
+                                   object_ids[2]: None})
+        minimock.assert_same_trace(self.tt, "Called Collection.find({'_id': {'$in': [ObjectId('...'), ObjectId('...'), ObjectId('...')]}})")
+
+    def test_coalesce_as_find_one(self):
+        class CoalescedResource(Resource):
+            _collection = 'argh'
+            _coalesce = 0
+            _read_preference = {'find_one': ReadPreference.PRIMARY, 'find_in': ReadPreference.SECONDARY_PREFERRED}
+            _metrics = MetricsRegistry(enabled=True)
+
+        object_id = ObjectId()
+        self.mocked_collection.find.mock_returns = [{'_id': object_id}]
+        self.assertEqual(CoalescedResource.find_one(object_id), {'_id': object_id})
+        minimock.assert_same_trace(
+            self.tt, "Called Collection.find({'_id': {'$in': [ObjectId('%s')]}}, read_preference=%d)" % (
+                object_id, ReadPreference.PRIMARY))
+        self.assertEqual(CoalescedResource._metrics.snapshot()['CoalescedResource'].keys(), ['find_one'])
+
+    def test_shard_find_in(self):
+        object_ids = [ObjectId() for _ in xrange(0, 2)]
+        while mongothin.object_id_shard({'_id': object_ids[0]}) == mongothin.object_id_shard({'_id': object_ids[1]}):
+            object_ids[1] = ObjectId()
+        object_ids.append(object_ids[0])
+        self.mocked_collection.find.mock_returns = [{'_id': object_ids[0]}]
+
+        documents = list(MongoResource.find_in(object_ids))
+        self.assertEqual(len(documents), 1)
+        # A single query, mongos routes it to the shards of the ids
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called Collection.find(",
+            "    {'_id': {'$in': [ObjectId('%s'), ObjectId('%s'), ObjectId('%s')]}, 'shard': {'$in': ['%s', '%s']}})" % (
+                object_ids[0], object_ids[1], object_ids[0], mongothin.object_id_shard({'_id': object_ids[0]}),
+                mongothin.object_id_shard({'_id': object_ids[1]})),
+        ]))
+
+        self.tt.clear()
+        MongoResource.find_in(object_ids[:1])
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called Collection.find(",
+            "    {'_id': {'$in': [ObjectId('%s')]}, 'shard': '%s'})" % (
+                object_ids[0], mongothin.object_id_shard({'_id': object_ids[0]})),
+        ]))
+
+    def test_find_in_unshardable(self):
+        class StringResource(Resource):
+            _collection = 'argh'
+            _id_type = str
+            _shard = (mongothin.object_id_shard, 'shard',)
+
+        StringResource.find_in(['not-hex'])
+        minimock.assert_same_trace(self.tt, "Called Collection.find({'_id': {'$in': ['not-hex']}})")
+
+    def test_cache(self):
+        object_id = ObjectId()
+        self.mocked_collection.find_one.mock_returns = {'_id': object_id}
+
+        class CachedResource(Resource):
+            _collection = 'argh'
+            _cache = LRUCache()
+
+        self.assertEqual(CachedResource.find_one(object_id), {'_id': object_id})
+        self.assertEqual(CachedResource.find_one(str(object_id)), {'_id': object_id})
+        self.assertEqual(list(CachedResource.find_in([object_id])), [{'_id': object_id}])
+        CachedResource.update_dict(object_id, {'test': 'test'})
+        CachedResource.find_one(object_id)
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called Collection.find_one({'_id': ObjectId('%s')})" % object_id,
+            "Called Collection.update({'_id': ObjectId('%s')}, {'$set': {'test': 'test'}})" % object_id,
+            "Called Collection.find_one({'_id': ObjectId('%s')})" % object_id,
+        ]))
+        self.assertEqual(CachedResource._cache.stats()['hits'], 2)
+
+    def test_cache_invalidated_during_read(self):
+        object_id = ObjectId()
+
+        class CachedResource(Resource):
+            _collection = 'argh'
+            _cache = LRUCache()
+
+        def read(*args, **kwargs):
+            # The document is updated while we read it
+            CachedResource._evict(object_id)
+            return {'_id': object_id}
+        self.mocked_collection.find_one.mock_returns_func = read
+        self.mocked_collection.find.mock_returns_func = lambda *args, **kwargs: [read()]
+
+        CachedResource.find_one(object_id)
+        self.assertIsNone(CachedResource._cache.get(object_id))
+        list(CachedResource.find_in([object_id]))
+        self.assertIsNone(CachedResource._cache.get(object_id))
+        self.mocked_collection.find_one.mock_returns_func = None
+        self.mocked_collection.find_one.mock_returns = {'_id': object_id}
+        CachedResource.find_one(object_id)
+        self.assertEqual(CachedResource._cache.get(object_id), {'_id': object_id})
+
+    def test_negative_cache(self):
+        object_ids = [ObjectId() for _ in xrange(0, 2)]
+        self.mocked_collection.find_one.mock_returns = None
+        self.mocked_collection.find.mock_returns = [{'_id': object_ids[0]}]
+
+        class NegativeCachedResource(Resource):
+            _collection = 'argh'
+            _negative_cache = LRUNegativeCache()
+
+        self.assertIsNone(NegativeCachedResource.find_one(object_ids[1]))
+        self.assertIsNone(NegativeCachedResource.find_one(str(object_ids[1])))
+        self.assertRaises(MissingIdsException, NegativeCachedResource.resolve, object_ids)
+        NegativeCachedResource.insert({}, object_ids[1])
+        NegativeCachedResource.find_one(object_ids[1])
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called Collection.find_one({'_id': ObjectId('%s')})" % object_ids[1],
+            "Called Collection.find({'_id': {'$in': [ObjectId('%s')]}})" % object_ids[0],
+            "Called Collection.insert({'_id': ObjectId('%s')})" % object_ids[1],
+            "Called Collection.find_one({'_id': ObjectId('%s')})" % object_ids[1],
+        ]))
+        self.assertEqual(NegativeCachedResource._negative_cache.stats()['hits'], 2)
+
+    def test_negative_cache_invalidated_during_read(self):
+        object_id = ObjectId()
+
+        class NegativeCachedResource(Resource):
+            _collection = 'argh'
+            _negative_cache = LRUNegativeCache()
+
+        def read(*args, **kwargs):
+            # The document is inserted while we read it
+            NegativeCachedResource._evict(object_id)
+            return None
+        self.mocked_collection.find_one.mock_returns_func = read
+        self.mocked_collection.find.mock_returns_func = lambda *args, **kwargs: read() or []
+
+        self.assertIsNone(NegativeCachedResource.find_one(object_id))
+        self.assertFalse(NegativeCachedResource._negative_cache.contains(object_id))
+        self.assertRaises(MissingIdsException, NegativeCachedResource.resolve, [object_id])
+        self.assertFalse(NegativeCachedResource._negative_cache.contains(object_id))
+        self.assertEqual(NegativeCachedResource.existing_ids([object_id]), set())
+        self.assertFalse(NegativeCachedResource._negative_cache.contains(object_id))
+        self.mocked_collection.find_one.mock_returns_func = None
+        self.mocked_collection.find_one.mock_returns = None
+        NegativeCachedResource.find_one(object_id)
+        self.assertTrue(NegativeCachedResource._negative_cache.contains(object_id))
+
+    def test_retries(self):
+        class RetriedResource(Resource):
+            _collection = 'argh'
+            _retries = 2
+            _delay = 0
+
+        self.mocked_collection.find_one.mock_raises = AutoReconnect('down')
+        self.assertRaises(AutoReconnect, RetriedResource.find_one, ObjectId())
+        self.assertEqual(len(self.tt.dump().splitlines()), 3)
+        RetriedResource._retries = 0
+        self.assertRaises(AutoReconnect, RetriedResource.find_one, ObjectId())
+        self.assertEqual(len(self.tt.dump().splitlines()), 4)
+
+    def test_dispatch_rebuilt_on_reconnect(self):
+        MongoResource.find_one(ObjectId())
+        mocked_collection = minimock.Mock('OtherCollection', tracker=self.tt)
+        minimock.mock('mongothin.resource.Resource._get_db', returns={'argh': mocked_collection})
+        MongoResource.find_one(ObjectId())
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called Collection.find_one({'_id': ObjectId('...'), 'shard': '...'})",
+            "Called OtherCollection.find_one({'_id': ObjectId('...'), 'shard': '...'})",
+        ]))
+
+    def test_iter_all(self):
+        self.mocked_collection.find.mock_returns_iter = [[{'_id': 1}, {'_id': 2}], [{'_id': 3}]]
+        documents = list(MongoResource.iter_all({'test': 'test'}, batch_size=2))
+        self.assertEqual(documents, [{'_id': 1}, {'_id': 2}, {'_id': 3}])
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called Collection.find({'test': 'test'}, limit=2, sort=[('_id', 1)])",
+            "Called Collection.find({'test': 'test', '_id': {'$gt': 2}}, limit=2, sort=[('_id', 1)])",
+        ]))
+
+    def test_iter_all_resume(self):
+        self.mocked_collection.find.mock_returns = []
+        self.assertEqual(list(MongoResource.iter_all({'_id': {'$lt': 10}}, start_after=5)), [])
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called Collection.find(",
+            "    {'$and': [{'_id': {'$lt': 10}}, {'_id': {'$gt': 5}}]},",
+            "    limit=1000,",
+            "    sort=[('_id', 1)])",
+        ]))
+
+    def test_segment_specs(self):
+        start = datetime.datetime(2013, 1, 1, tzinfo=bson.tz_util.utc)
+        self.mocked_collection.find_one.mock_returns_iter = [
+            {'_id': ObjectId.from_datetime(start)},
+            {'_id': ObjectId.from_datetime(start + datetime.timedelta(hours=3))},
+        ]
+        specs = MongoResource._segment_specs({'test': 'test'}, 3)
+        bounds = [ObjectId.from_datetime(start + datetime.timedelta(hours=i)) for i in (1, 2)]
+        self.assertEqual(specs, [
+            {'test': 'test', '_id': {'$lt': bounds[0]}},
+            {'test': 'test', '_id': {'$gte': bounds[0], '$lt': bounds[1]}},
+            {'test': 'test', '_id': {'$gte': bounds[1]}},
+        ])
+        self.assertIn("    fields={'_id': 1},\n    sort=[('_id', 1)])", self.tt.dump())
+        self.assertRaises(ValueError, MongoResource._segment_specs, {}, 0)
+
+    def test_scan(self):
+        class FakeResource(object):
+            @staticmethod
+            def iter_all(specs, batch_size):
+                return iter(specs)
+
+        segments = [range(0, 10), range(10, 20), range(20, 30)]
+        self.assertEqual(list(scan(FakeResource, segments, 2, ordered=True, queue_size=2)), range(0, 30))
+        self.assertEqual(sorted(scan(FakeResource, segments, 2, queue_size=2)), range(0, 30))
+
+    def test_retry_policy(self):
+        class RetriedResource(Resource):
+            _collection = 'argh'
+            _retry_policy = RetryPolicy(retries=5, delay=0, retryable=(ValueError,))
+
+        self.mocked_collection.find_one.mock_raises = ValueError('boom')
+        self.assertRaises(ValueError, RetriedResource.find_one, ObjectId())
+        self.assertEqual(len(self.tt.dump().splitlines()), 6)
+
+    def test_circuit_breaker(self):
+        mongothin.connection.register_circuit_breaker('default', min_calls=1)
+        self.mocked_collection.find_one.mock_raises = AutoReconnect('down')
+        self.assertRaises(AutoReconnect, MongoResource.find_one, ObjectId())
+        self.assertRaises(mongothin.connection.CircuitOpenError, MongoResource.find_one, ObjectId())
+        minimock.assert_same_trace(self.tt, "Called Collection.find_one({'_id': ObjectId('...'), 'shard': '...'})")
+
+    def test_circuit_breaker_probe(self):
+        breaker = mongothin.connection.register_circuit_breaker('default', min_calls=1, reset_timeout=0)
+        breaker.acquire()
+        breaker.record(AutoReconnect('down'))
+
+        class LazyCursor(Cursor):
+            def __init__(self):
+                pass
+
+            def __del__(self):
+                pass
+
+        self.mocked_collection.find.mock_returns = LazyCursor()
+        PlainResource.find({})
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.mocked_collection.find_one.mock_raises = Interrupted()
+        self.assertRaises(Interrupted, PlainResource.find_one, ObjectId())
+        self.assertTrue(breaker.acquire())
+
+    def test_metrics(self):
+        class MeasuredResource(Resource):
+            _collection = 'argh'
+            _retries = 1
+            _delay = 0
+            _metrics = MetricsRegistry(enabled=True)
+
+        MeasuredResource.find_one(ObjectId())
+        self.mocked_collection.find_one.mock_raises = AutoReconnect('down')
+        self.assertRaises(AutoReconnect, MeasuredResource.find_one, ObjectId())
+        snapshot = MeasuredResource._metrics.snapshot()['MeasuredResource']['find_one']
+        self.assertEqual(snapshot['calls'], 2)
+        self.assertEqual(snapshot['errors'], 1)
+        self.assertEqual(snapshot['retries'], 1)
+
+    def test_metrics_cursor(self):
+        class MeasuredResource(Resource):
+            _collection = 'argh'
+            _metrics = MetricsRegistry(enabled=True)
+
+        self.mocked_collection.find.mock_returns = ScriptedCursor([{'_id': 1}])
+        cursor = MeasuredResource.find({})
+        self.assertIsInstance(cursor, ScriptedCursor)
+        self.assertEqual(MeasuredResource._metrics.snapshot(), {})
+        self.assertEqual(list(cursor), [{'_id': 1}])
+        snapshot = MeasuredResource._metrics.snapshot()['MeasuredResource']['find']
+        self.assertEqual(snapshot['calls'], 1)
+        # Both fetches, not only the creation of the cursor
+        self.assertGreaterEqual(snapshot['latency'], 0.02)
+
+        self.mocked_collection.find.mock_returns = ScriptedCursor(AutoReconnect('down'))
+        self.assertRaises(AutoReconnect, list, MeasuredResource.find({}))
+        self.mocked_collection.find.mock_returns = ScriptedCursor([{'_id': 1}])
+        MeasuredResource.find({}).close()
+        snapshot = MeasuredResource._metrics.snapshot()['MeasuredResource']['find']
+        self.assertEqual(snapshot['calls'], 3)
+        self.assertEqual(snapshot['errors'], 1)
+
+    def test_sampler_cursor(self):
+        class SampledResource(Resource):
+            _collection = 'argh'
+            _sampler = SlowQuerySampler(threshold=0.015, logger=logging.getLogger('test'))
+
+        object_id = ObjectId()
+        self.mocked_collection.find.mock_returns = ScriptedCursor([{'_id': object_id}])
+        self.assertEqual(SampledResource.resolve([object_id]), [{'_id': object_id}])
+        report = SampledResource._sampler.report()
+        self.assertEqual([(row['operation'], row['shape']) for row in report],
+                         [('resolve', '{_id: {$in: [ObjectId]}}')])
+
+    def test_metrics_operations(self):
+        class MeasuredResource(Resource):
+            _collection = 'argh'
+            _metrics = MetricsRegistry(enabled=True)
+
+        object_id = ObjectId()
+        self.mocked_collection.find.mock_returns = [{'_id': object_id}]
+        MeasuredResource.find_in([object_id])
+        MeasuredResource.resolve([object_id])
+        MeasuredResource.existing_ids([object_id])
+        MeasuredResource.insert_many([{'_id': object_id}])
+        self.assertEqual(sorted(MeasuredResource._metrics.snapshot()['MeasuredResource']),
+                         ['existing_ids', 'find_in', 'insert_many', 'resolve'])
+
+    def test_resolve_order(self):
+        object_ids = [ObjectId() for _ in xrange(0, 3)]
+        self.mocked_collection.find.mock_returns_func = lambda specs: [{'_id': _id} for _id in specs['_id']['$in']]
+        documents = PlainResource.resolve([str(object_ids[2]), object_ids[0], str(object_ids[1])], chunk_size=2)
+        self.assertEqual(documents, [{'_id': object_ids[2]}, {'_id': object_ids[0]}, {'_id': object_ids[1]}])
+        self.assertEqual(PlainResource.resolve(object_ids[:1], as_dict=True), {object_ids[0]: {'_id': object_ids[0]}})
+
+    def test_resolve_missing(self):
+        object_ids = [ObjectId() for _ in xrange(0, 3)]
+        self.mocked_collection.find.mock_returns = [{'_id': object_ids[0]}]
+        try:
+            PlainResource.resolve([str(_id) for _id in object_ids])
+        except MissingIdsException as exc:
+            self.assertEqual(exc.args[0], set(object_ids[1:]))
+        else:
+            self.fail('MissingIdsException not raised')
+        self.assertEqual(next(PlainResource.iter_resolve(object_ids[:1])), {'_id': object_ids[0]})
+        self.assertRaises(MissingIdsException, list, PlainResource.iter_resolve(object_ids))
+
+    def test_iter_resolve_args(self):
+        object_ids = [ObjectId() for _ in xrange(0, 3)]
+        self.mocked_collection.find.mock_returns_func = lambda specs, fields: [
+            {'_id': _id} for _id in specs['_id']['$in']]
+        documents = list(PlainResource.iter_resolve(object_ids, {'_id': 1}, chunk_size=2))
+        self.assertEqual(documents, [{'_id': _id} for _id in object_ids])
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called Collection.find({'_id': {'$in': [ObjectId('%s'), ObjectId('%s')]}}, {'_id': 1})"
+            % tuple(object_ids[:2]),
+            "Called Collection.find({'_id': {'$in': [ObjectId('%s')]}}, {'_id': 1})" % object_ids[2],
+        ]))
+
+    def test_existing_ids(self):
+        object_ids = [ObjectId() for _ in xrange(0, 3)]
+        self.mocked_collection.find.mock_returns = [{'_id': object_ids[0]}]
+        self.assertTrue(PlainResource.exists(str(object_ids[0])))
+        self.assertEqual(MongoResource.existing_ids(object_ids[:2]), set(object_ids[:1]))
+        self.assertRaises(MissingIdsException, PlainResource.resolve, object_ids[:2], check_missing=True)
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called Collection.find({'_id': {'$in': [ObjectId('%s')]}}, fields={'_id': 1})" % object_ids[0],
+            "Called Collection.find(",
+            "    {'_id': {'$in': [ObjectId('%s'), ObjectId('%s')]}, 'shard': {'$in': ['%s', '%s']}}," % (
+                object_ids[0], object_ids[1], mongothin.object_id_shard({'_id': object_ids[0]}),
+                mongothin.object_id_shard({'_id': object_ids[1]})),
+            "    fields={'_id': 1})",
+            "Called Collection.find({'_id': {'$in': [ObjectId('%s'), ObjectId('%s')]}}, fields={'_id': 1})" % (
+                object_ids[0], object_ids[1]),
+        ]))
+
+    def test_aggregate(self):
+        object_id = ObjectId()
+        shard = mongothin.object_id_shard({'_id': object_id})
+        pipeline = [{'$match': {'_id': object_id}}, {'$project': {'a': 1}}]
+        MongoResource.aggregate(pipeline, batch_size=100, allow_disk_use=True)
+        MongoResource.aggregate([{'$group': {'_id': '$a'}}])
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called Collection.aggregate(",
+            "    [{'$match': {'_id': ObjectId('%s'), 'shard': '%s'}}, {'$project': {'a': 1}}]," % (object_id, shard),
+            "    allowDiskUse=True,",
+            "    cursor={'batchSize': 100})",
+            "Called Collection.aggregate([{'$group': {'_id': '$a'}}], cursor={})",
+        ]))
+        self.assertEqual(pipeline[0], {'$match': {'_id': object_id}})
+
+    def test_read_preference(self):
+        class SecondaryResource(Resource):
+            _collection = 'argh'
+            _read_preference = {'find': ReadPreference.SECONDARY_PREFERRED, 'find_in': ReadPreference.SECONDARY}
+            _secondary_latency_ms = 5
+
+        SecondaryResource.find({})
+        SecondaryResource.find({}, read_preference=ReadPreference.PRIMARY)
+        SecondaryResource.find_one(ObjectId())
+        SecondaryResource.find_in([])
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called Collection.find(",
+            "    {},",
+            "    limit=10,",
+            "    read_preference=%d," % ReadPreference.SECONDARY_PREFERRED,
+            "    secondary_acceptable_latency_ms=5,",
+            "    skip=0)",
+            "Called Collection.find({}, limit=10, read_preference=%d, skip=0)" % ReadPreference.PRIMARY,
+            "Called Collection.find_one({'_id': ObjectId('...')})",
+            "Called Collection.find(",
+            "    {'_id': {'$in': []}},",
+            "    read_preference=%d," % ReadPreference.SECONDARY,
+            "    secondary_acceptable_latency_ms=5)",
+        ]))
+
+    def test_read_preference_with_options(self):
+        minimock.mock('mongothin.resource.WITH_OPTIONS', mock_obj=True)
+        secondary = minimock.Mock('Secondary', tracker=self.tt)
+        self.mocked_collection.with_options.mock_returns = secondary
+
+        class SecondaryResource(Resource):
+            _collection = 'argh'
+            _read_preference = {'find_in': ReadPreference.SECONDARY}
+
+        object_id = ObjectId()
+        secondary.find.mock_returns = [{'_id': object_id}]
+        SecondaryResource.resolve([object_id])
+        SecondaryResource.existing_ids([object_id])
+        SecondaryResource.find_one(object_id)
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called Collection.with_options(read_preference=%d)" % ReadPreference.SECONDARY,
+            "Called Secondary.find({'_id': {'$in': [ObjectId('%s')]}})" % object_id,
+            "Called Secondary.find({'_id': {'$in': [ObjectId('%s')]}}, fields={'_id': 1})" % object_id,
+            "Called Collection.find_one({'_id': ObjectId('%s')})" % object_id,
+        ]))
+
+    def test_default_fields(self):
+        class ProjectedResource(Resource):
+            _collection = 'argh'
+            _default_fields = {'name': 1}
+
+        object_id = ObjectId()
+        ProjectedResource.find_one(object_id)
+        ProjectedResource.find_one(object_id, None, {'other': 1})
+        ProjectedResource.find({}, fields={'other': 1})
+        ProjectedResource.find_in([object_id])
+        minimock.assert_same_trace(self.tt, '\n'.join([
+            "Called Collection.find_one({'_id': ObjectId('...')}, fields={'name': 1})",
+            "Called Collection.find_one({'_id': ObjectId('...')}, {'other': 1})",
+            "Called Collection.find({}, fields={'other': 1}, limit=10, skip=0)",
+            "Called Collection.find({'_id': {'$in': [ObjectId('...')]}}, fields={'name': 1})",
+        ]))
+
+    def test_default_fields_keys(self):
+        class ProjectedResource(Resource):
+            _collection = 'argh'
+            _default_fields = {'name': 1, '_id': 0}
+
+        class ExcludingResource(Resource):
+            _collection = 'argh'
+            _default_fields = {'big': 0, 'rank': 0}
+
+        self.mocked_collection.find.mock_returns = []
+        ProjectedResource.find_in([ObjectId()])
+        list(ProjectedResource.iter_all(sort_key='rank'))
+        list(ExcludingResource.iter_all(sort_key='rank'))
+        trace = self.tt.dump().replace('\n    ', ' ')
+        self.assertIn("fields={'name': 1})", trace)
+        self.assertIn("fields={'name': 1, 'rank': 1}, limit=1000, sort=[('rank', 1)])", trace)
+        self.assertIn("fields={'big': 0}, limit=1000, sort=[('rank', 1)])", trace)
+
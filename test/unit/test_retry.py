@@ -0,0 +1,37 @@
+# coding=utf-8
+import time
+import unittest
+
+from mongothin.retry import RetryBudget, RetryPolicy
+
+
+class TestRetryPolicy(unittest.TestCase):
+    """Test the retry policies
+
+    """
+
+    def test_backoff(self):
+        policy = RetryPolicy(retries=2, delay=0.01)
+        started = time.time()
+        self.assertEqual(policy.backoff(0, started), 0.01)
+        self.assertEqual(policy.backoff(1, started), 0.02)
+        self.assertIsNone(policy.backoff(2, started))
+
+    def test_jitter(self):
+        policy = RetryPolicy(retries=5, delay=0.01, max_delay=0.02, jitter=True)
+        for _ in xrange(0, 20):
+            self.assertTrue(0 <= policy.backoff(4, time.time()) <= 0.02)
+
+    def test_deadline(self):
+        policy = RetryPolicy(retries=5, delay=0.01, deadline=0.1)
+        self.assertEqual(policy.backoff(0, time.time()), 0.01)
+        self.assertIsNone(policy.backoff(0, time.time() - 0.095))
+
+    def test_budget(self):
+        budget = RetryBudget(ratio=0.5, max_tokens=1)
+        policy = RetryPolicy(retries=5)
+        self.assertIsNotNone(policy.backoff(0, time.time(), budget))
+        self.assertIsNone(policy.backoff(0, time.time(), budget))
+        budget.deposit()
+        budget.deposit()
+        self.assertIsNotNone(policy.backoff(0, time.time(), budget))
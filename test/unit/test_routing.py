@@ -0,0 +1,90 @@
+# coding=utf-8
+import unittest
+
+from bson import ObjectId
+import minimock
+
+import mongothin
+import mongothin.connection
+from mongothin.routing import RoutedResource
+
+
+ALIASES = ('first', 'second')
+
+
+class MongoResource(RoutedResource):
+    _collection = 'argh'
+    _aliases = ALIASES
+    _router = mongothin.object_id_router(ALIASES)
+
+
+def object_id_on(alias):
+    while True:
+        object_id = ObjectId()
+        if MongoResource._route({'_id': object_id}) == alias:
+            return object_id
+
+
+class TestRoutedResource(unittest.TestCase):
+    def setUp(self):
+        """Setup
+
+        """
+        super(TestRoutedResource, self).setUp()
+        self.tt = minimock.TraceTracker()
+        self.dbs = dict((alias, {'argh': minimock.Mock(alias, tracker=self.tt)}) for alias in ALIASES)
+        minimock.mock('mongothin.resource.Resource._get_db', mock_obj=classmethod(lambda cls: self.dbs[cls._alias]))
+
+    def tearDown(self):
+        """Teardown
+
+        """
+        super(TestRoutedResource, self).tearDown()
+        minimock.restore()
+
+    def test_router(self):
+        router = mongothin.object_id_router(ALIASES)
+        self.assertEqual(router({'_id': ObjectId('000000000000000000000000')}), 'first')
+        self.assertEqual(router({'_id': ObjectId('0000000000000000000002a3')}), 'second')
+        self.assertIsNone(router({}))
+
+    def test_insert(self):
+        object_id = object_id_on('second')
+        MongoResource.insert({'test': 'test'}, object_id)
+        minimock.assert_same_trace(self.tt, "Called second.insert({'test': 'test', '_id': ObjectId('%s')})" % object_id)
+
+    def test_update_scatter(self):
+        self.dbs['first']['argh'].update.mock_returns = {'n': 1}
+        self.dbs['second']['argh'].update.mock_returns = {'n': 2}
+        self.assertEqual(MongoResource.update(None, {'$set': {'a': 1}}, {'test': 'test'}), 3)
+
+    def test_find(self):
+        self.dbs['first']['argh'].find.mock_returns = [{'a': 1}, {'a': 3}]
+        self.dbs['second']['argh'].find.mock_returns = [{'a': 2}]
+        documents = MongoResource.find({}, skip=1, limit=2, sort=[('a', -1)])
+        self.assertEqual(documents, [{'a': 2}, {'a': 1}])
+        self.assertIn("Called first.find({}, limit=3, skip=0, sort=[('a', -1)])", self.tt.dump())
+
+    def test_find_in(self):
+        object_ids = [object_id_on('first'), object_id_on('second')]
+        self.dbs['first']['argh'].find.mock_returns = [{'_id': object_ids[0]}]
+        self.dbs['second']['argh'].find.mock_returns = [{'_id': object_ids[1]}]
+        documents = MongoResource.resolve([str(object_id) for object_id in object_ids])
+        self.assertEqual(documents, [{'_id': object_ids[0]}, {'_id': object_ids[1]}])
+        trace = self.tt.dump()
+        self.assertIn("Called first.find({'_id': {'$in': [ObjectId('%s')]}})" % object_ids[0], trace)
+        self.assertIn("Called second.find({'_id': {'$in': [ObjectId('%s')]}})" % object_ids[1], trace)
+
+    def test_existing_ids(self):
+        object_ids = [object_id_on('first'), object_id_on('second')]
+        self.dbs['first']['argh'].find.mock_returns = []
+        self.dbs['second']['argh'].find.mock_returns = [{'_id': object_ids[1]}]
+        self.assertEqual(MongoResource.existing_ids(object_ids), set(object_ids[1:]))
+        self.assertIn("Called first.find(\n    {'_id': {'$in': [ObjectId('%s')]}},\n    fields={'_id': 1})" % object_ids[0],
+                      self.tt.dump())
+
+    def test_need_alias(self):
+        self.assertRaises(ValueError, MongoResource.aggregate, [])
+        self.assertRaises(ValueError, MongoResource.parallel_scan)
+        MongoResource.for_alias('second').aggregate([{'$match': {'a': 1}}])
+        minimock.assert_same_trace(self.tt, "Called second.aggregate([{'$match': {'a': 1}}], cursor={})")
@@ -0,0 +1,70 @@
+# coding=utf-8
+import logging
+import unittest
+
+from bson import ObjectId
+
+from mongothin.sampler import SlowQuerySampler, explain_summary, shape_key, spec_shape
+
+
+class FakeResource(object):
+    _collection = 'argh'
+    _alias = 'default'
+
+    @classmethod
+    def _make_call_as(cls, operation, function):
+        return {'cursor': 'BtreeCursor _id_'}
+
+
+class TestSampler(unittest.TestCase):
+    """Test the slow query sampler
+
+    """
+
+    def test_spec_shape(self):
+        shape = spec_shape({'_id': {'$in': [ObjectId(), ObjectId()]}, 'shard': 'AB', 'count': 1})
+        self.assertEqual(shape, {'_id': {'$in': ['ObjectId']}, 'shard': 'str', 'count': 'int'})
+        self.assertEqual(shape_key(shape), '{_id: {$in: [ObjectId]}, count: int, shard: str}')
+
+    def test_explain_summary(self):
+        self.assertEqual(explain_summary({'cursor': 'BtreeCursor _id_'}), {'indexed': True, 'shards': 1})
+        self.assertEqual(explain_summary({'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}}),
+                         {'indexed': False, 'shards': 1})
+        self.assertEqual(explain_summary({'shards': {'a': [{'cursor': 'BtreeCursor _id_'}],
+                                                     'b': [{'cursor': 'BasicCursor'}]}}),
+                         {'indexed': False, 'shards': 2})
+
+    def test_explain_summary_mongos(self):
+        scatter = {'queryPlanner': {'winningPlan': {'stage': 'SHARD_MERGE', 'shards': [
+            {'shardName': 'rs0', 'winningPlan': {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}},
+            {'shardName': 'rs1', 'winningPlan': {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}},
+            {'shardName': 'rs2', 'winningPlan': {'stage': 'COLLSCAN'}},
+        ]}}}
+        self.assertEqual(explain_summary(scatter), {'indexed': False, 'shards': 3})
+        targeted = {'queryPlanner': {'winningPlan': {'stage': 'SINGLE_SHARD', 'shards': [
+            {'shardName': 'rs0', 'winningPlan': {'stage': 'IDHACK'}},
+        ]}}}
+        self.assertEqual(explain_summary(targeted), {'indexed': True, 'shards': 1})
+
+    def test_sample(self):
+        sampler = SlowQuerySampler(threshold=0.1, logger=logging.getLogger('test'))
+        sampler.sample(FakeResource, 'find_one', ({'_id': ObjectId()},), 0.05, 0)
+        sampler.sample(FakeResource, 'find_one', ({'_id': ObjectId()},), 0.2, 1)
+        sampler.sample(FakeResource, 'find_one', ({'_id': ObjectId()},), 0.3, 0)
+        report = sampler.report()
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]['shape'], '{_id: ObjectId}')
+        self.assertEqual(report[0]['count'], 2)
+        self.assertEqual(report[0]['max'], 0.3)
+        self.assertEqual(report[0]['retries'], 1)
+        self.assertIsNone(report[0]['indexed'])
+
+    def test_explain_after_reset(self):
+        sampler = SlowQuerySampler(threshold=0.1, logger=logging.getLogger('test'))
+        sampler.sample(FakeResource, 'find_one', ({'_id': ObjectId()},), 0.2, 0)
+        key = ('argh', 'find_one', '{_id: ObjectId}')
+        sampler._explain(FakeResource, key, {'_id': ObjectId()})
+        self.assertTrue(sampler.report()[0]['indexed'])
+        sampler.reset()
+        sampler._explain(FakeResource, key, {'_id': ObjectId()})
+        self.assertEqual(sampler.report(), [])
@@ -0,0 +1,31 @@
+# coding=utf-8
+import unittest
+
+from bson import ObjectId
+
+import mongothin
+
+
+class TestObjectIdShard(unittest.TestCase):
+    """Test the ObjectId sharder
+
+    """
+
+    def test_labels(self):
+        self.assertEqual(len(mongothin.SHARD_LABELS), 676)
+        self.assertEqual(mongothin.SHARD_LABELS[0], 'AA')
+        self.assertEqual(mongothin.SHARD_LABELS[-1], 'ZZ')
+
+    def test_object_id_shard(self):
+        object_id = ObjectId('507f1f77bcf86cd799439011')
+        expected = mongothin.base_encode(int(str(object_id), 16) % 676)
+        self.assertEqual(mongothin.object_id_shard({'_id': object_id}), expected)
+        self.assertEqual(mongothin.object_id_shard({'_id': str(object_id)}), expected)
+        self.assertIsNone(mongothin.object_id_shard({'_id': 12}))
+        self.assertIsNone(mongothin.object_id_shard({}))
+
+    def test_object_id_shard_many(self):
+        object_ids = [ObjectId() for _ in xrange(0, mongothin.NUMPY_THRESHOLD)]
+        expected = [mongothin.object_id_shard({'_id': object_id}) for object_id in object_ids]
+        self.assertEqual(mongothin.object_id_shard_many(object_ids), expected)
+        self.assertEqual(mongothin.object_id_shard_many(object_ids[:10] + [12]), expected[:10] + [None])
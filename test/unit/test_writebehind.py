@@ -0,0 +1,93 @@
+# coding=utf-8
+import unittest
+
+from bson import ObjectId
+import minimock
+
+import mongothin.connection
+from mongothin.resource import Resource
+from mongothin.writebehind import WriteBehindBuffer, merge_update
+
+
+class MongoResource(Resource):
+    _collection = 'argh'
+    _write_behind = WriteBehindBuffer(max_pending=2, max_age=60)
+
+
+class TestWriteBehind(unittest.TestCase):
+    def setUp(self):
+        """Setup
+
+        """
+        super(TestWriteBehind, self).setUp()
+        mongothin.connection.register_connection('default', 'mongothin')
+
+        self.tt = minimock.TraceTracker()
+        self.mocked_collection = minimock.Mock('Collection', tracker=self.tt)
+        self.mocked_bulk = minimock.Mock('Bulk', tracker=self.tt)
+        self.mocked_bulk.find.mock_returns = self.mocked_bulk
+        self.mocked_collection.initialize_unordered_bulk_op.mock_returns = self.mocked_bulk
+        minimock.mock('mongothin.resource.Resource._get_db', returns={'argh': self.mocked_collection})
+
+    def tearDown(self):
+        """Teardown
+
+        """
+        super(TestWriteBehind, self).tearDown()
+        mongothin.connection._connection_settings.clear()
+        minimock.restore()
+
+    def test_merge_update(self):
+        pending = {}
+        merge_update(pending, {'$set': {'a': 1, 'b': 'b'}})
+        merge_update(pending, {'$inc': {'a': 2, 'c': 1}})
+        merge_update(pending, {'$inc': {'c': 1}})
+        merge_update(pending, {'$set': {'c': 0}})
+        self.assertEqual(pending, {'$set': {'a': 3, 'b': 'b', 'c': 0}, '$inc': {}})
+
+    def test_merge_update_conflict(self):
+        pending = {'$set': {'a': 'a', 'b': True}}
+        self.assertRaises(ValueError, merge_update, pending, {'$inc': {'a': 1}})
+        self.assertRaises(ValueError, merge_update, pending, {'$inc': {'c': 1, 'b': 1}})
+        self.assertRaises(ValueError, merge_update, pending, {'$inc': {'c': None}})
+        self.assertEqual(pending, {'$set': {'a': 'a', 'b': True}})
+
+    def test_conflict_writes_pending(self):
+        object_id = ObjectId()
+        MongoResource.update_dict(object_id, {'count': None})
+        MongoResource.inc_dict(object_id, {'count': 1})
+        self.assertEqual(MongoResource._write_behind.pending(), 1)
+        trace = self.tt.dump()
+        self.assertIn("Called Bulk.update_one({'$set': {'count': None}})", trace)
+        self.assertNotIn("'$inc': {'count': 1}", trace)
+        self.assertRaises(ValueError, MongoResource.inc_dict, object_id, {'count': 'a'})
+        MongoResource._write_behind.flush()
+        self.assertIn("Called Bulk.update_one({'$inc': {'count': 1}})", self.tt.dump())
+
+    def test_flush_on_size(self):
+        object_ids = [ObjectId(), ObjectId()]
+        self.assertIsNone(MongoResource.update_dict(object_ids[0], {'seen': 1}))
+        MongoResource.inc_dict(object_ids[0], {'count': 1})
+        MongoResource.inc_dict(object_ids[0], {'count': 1})
+        self.assertEqual(MongoResource._write_behind.pending(), 1)
+        self.assertEqual(self.tt.dump(), '')
+
+        MongoResource.inc_dict(object_ids[1], {'count': 1})
+        self.assertEqual(MongoResource._write_behind.pending(), 0)
+        trace = self.tt.dump()
+        self.assertIn("Called Bulk.update_one({'$set': {'seen': 1}, '$inc': {'count': 2}})", trace)
+        self.assertIn("Called Bulk.update_one({'$inc': {'count': 1}})", trace)
+        self.assertIn("Called Bulk.execute()", trace)
+
+    def test_fork(self):
+        buffer = WriteBehindBuffer(max_pending=10, max_age=60)
+        buffer.add(MongoResource, {'_id': ObjectId()}, {'$inc': {'count': 1}})
+        thread = buffer._thread
+        buffer._pid = -1  # As if created in the parent
+        self.assertEqual(buffer.pending(), 0)
+        buffer.flush()
+        self.assertEqual(self.tt.dump(), '')
+        buffer.add(MongoResource, {'_id': ObjectId()}, {'$inc': {'count': 1}})
+        self.assertIsNot(buffer._thread, thread)
+        self.assertEqual(buffer.pending(), 1)
+        buffer.flush()